@@ -0,0 +1,236 @@
+'''
+On-disk cache of formatted, tokenized training data for the RA-CNN.
+
+Reading the formatted CSV, building Documents, fitting the Preprocessor
+and generating the sentence sequences of every document takes a long
+time, and used to be repeated at the start of every training (and
+evaluation) run. Instead, the result is compiled once into a directory
+of NumPy files:
+
+    meta.json               cache version, source file and preprocessor
+                            parameters, sizes
+    vocab.json              the fitted vocabulary (token -> index)
+    doc_ids.json            document ids, in order
+    doc_offsets.npy         document i holds sentences
+                            doc_offsets[i]:doc_offsets[i+1] of
+    tokens.npy              (sentences x max_sent_len) int32 sequences,
+                            padded as by Preprocessor.build_sequences
+    sentence_labels.npy     (sentences x SENT_OUTCOMES) labels
+    sentence_text.npy       UTF-8 text of the sentences, concatenated,
+    sentence_text_offsets.npy   and the offsets of each in it
+    doc_labels.npz          (documents x 3) one-hot labels per DOC_OUTCOME
+
+The .npy files are memory mapped when read, so loading takes seconds.
+The cache is rebuilt whenever the source data, the preprocessing
+parameters or CACHE_VERSION change.
+
+Usage:
+
+    python RA_CNN_cache.py -i data/splits/train-df.csv -o data/cache/train
+'''
+
+import os
+import json
+import shutil
+import optparse
+
+import numpy as np
+
+import RA_CNN_redux
+from RA_CNN_redux import Document
+
+# bump this whenever the layout (or meaning) of the files changes
+CACHE_VERSION = 2
+
+META_FILE = "meta.json"
+
+
+def source_info(path):
+    '''
+    Size and modification time of the (formatted) data at path, to tell
+    whether a cache built from it is stale; path may be a directory (of
+    normalized data).
+    '''
+    if os.path.isdir(path):
+        size, mtime = 0, 0.0
+        for dir_path, _, file_names in os.walk(path):
+            for file_name in file_names:
+                stat = os.stat(os.path.join(dir_path, file_name))
+                size, mtime = size + stat.st_size, max(mtime, stat.st_mtime)
+    else:
+        stat = os.stat(path)
+        size, mtime = stat.st_size, stat.st_mtime
+    return {"path": os.path.abspath(path), "size": size, "mtime": mtime}
+
+
+def preprocessor_params(p):
+    return {"max_features": p.max_features, "max_sent_len": p.max_sent_len,
+            "max_doc_len": p.max_doc_len, "stopword": p.stopword}
+
+
+def read_meta(cache_dir):
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as meta_f:
+        return json.load(meta_f)
+
+
+def is_current(cache_dir, source, params, p=None):
+    '''
+    Is there a cache in cache_dir, built from source (see source_info)
+    with the given preprocessor parameters (and, if p is given, by a
+    preprocessor with the same fingerprint)?
+    '''
+    meta = read_meta(cache_dir)
+    if meta is None:
+        return False
+    current = (meta["version"] == CACHE_VERSION and meta["source"] == source and
+                    meta["params"] == params)
+    if p is not None:
+        current = current and meta["fingerprint"] == p.fingerprint()
+    return current
+
+
+def _json_safe(value):
+    # (numpy scalars, e.g. numeric doc_ids)
+    return value.item() if hasattr(value, "item") else value
+
+
+def write_cache(cache_dir, documents, p, source):
+    '''
+    Write documents (with their sentence sequences as generated by p)
+    and p's vocabulary to cache_dir. The
+    files are written to a temporary directory, which then replaces
+    cache_dir.
+    '''
+    tmp_dir = cache_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    doc_offsets = np.concatenate([[0], np.cumsum([d.n for d in documents])]).astype(np.int64)
+    n_sentences = int(doc_offsets[-1])
+    tokens = np.lib.format.open_memmap(os.path.join(tmp_dir, "tokens.npy"), mode="w+",
+                                        dtype=np.int32, shape=(n_sentences, p.max_sent_len))
+    sentence_labels = np.zeros((n_sentences, len(RA_CNN_redux.SENT_OUTCOMES)), dtype=np.float32)
+    for doc_idx, d in enumerate(documents):
+        start, end = doc_offsets[doc_idx], doc_offsets[doc_idx+1]
+        tokens[start:end] = d.get_sequences(p)
+        if d.sentence_labels is not None:
+            sentence_labels[start:end] = d.sentence_labels
+    tokens.flush()
+    del tokens
+    np.save(os.path.join(tmp_dir, "sentence_labels.npy"), sentence_labels)
+    np.save(os.path.join(tmp_dir, "doc_offsets.npy"), doc_offsets)
+
+    encoded = [s.encode("utf-8") for d in documents for s in d.sentences]
+    text_offsets = np.concatenate([[0], np.cumsum([len(s) for s in encoded])]).astype(np.int64)
+    np.save(os.path.join(tmp_dir, "sentence_text.npy"),
+                np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    np.save(os.path.join(tmp_dir, "sentence_text_offsets.npy"), text_offsets)
+
+    doc_labels = {}
+    if len(documents) > 0 and documents[0].doc_y_dict is not None:
+        for lbl_name in documents[0].doc_y_dict:
+            doc_labels[lbl_name] = np.vstack([d.doc_y_dict[lbl_name] for d in documents])
+    np.savez(os.path.join(tmp_dir, "doc_labels.npz"), **doc_labels)
+
+    with open(os.path.join(tmp_dir, "vocab.json"), "w") as vocab_f:
+        json.dump(p.tokenizer.word_index, vocab_f)
+    with open(os.path.join(tmp_dir, "doc_ids.json"), "w") as ids_f:
+        json.dump([_json_safe(d.doc_id) for d in documents], ids_f)
+
+    meta = {"version": CACHE_VERSION, "source": source, "params": preprocessor_params(p),
+            "fingerprint": p.fingerprint(),
+            "n_documents": len(documents), "n_sentences": n_sentences}
+    # (written last: a directory without it is not a cache)
+    with open(os.path.join(tmp_dir, META_FILE), "w") as meta_f:
+        json.dump(meta, meta_f, indent=1, sort_keys=True)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+    print("cached {0} documents ({1} sentences) in {2}".format(len(documents), n_sentences,
+                                                                    cache_dir))
+
+
+def load_cache(cache_dir, p=None, wvs=None, mmap_mode="r"):
+    '''
+    Read back (documents, preprocessor) from cache_dir. Sentence
+    sequences are views of the (memory mapped) token matrix. Unless p is
+    given, the preprocessor is rebuilt from the cached vocabulary (with
+    word vectors wvs, if given).
+    '''
+    meta = read_meta(cache_dir)
+    if meta is None or meta["version"] != CACHE_VERSION:
+        raise ValueError("{0} does not hold a (version {1}) cache".format(cache_dir, CACHE_VERSION))
+
+    if p is None:
+        with open(os.path.join(cache_dir, "vocab.json")) as vocab_f:
+            word_index = json.load(vocab_f)
+        p = RA_CNN_redux.Preprocessor(wvs=wvs, **meta["params"])
+        p.set_vocabulary(word_index)
+        if p.use_pretrained_embeddings:
+            p.init_word_vectors()
+
+    def load(name):
+        return np.load(os.path.join(cache_dir, name), mmap_mode=mmap_mode)
+
+    tokens, sentence_labels = load("tokens.npy"), load("sentence_labels.npy")
+    doc_offsets = load("doc_offsets.npy")
+    text, text_offsets = load("sentence_text.npy"), load("sentence_text_offsets.npy")
+    with np.load(os.path.join(cache_dir, "doc_labels.npz")) as doc_labels_f:
+        doc_labels = dict(doc_labels_f.items())
+    with open(os.path.join(cache_dir, "doc_ids.json")) as ids_f:
+        doc_ids = json.load(ids_f)
+
+    text = text.tobytes()
+    sentences = [text[text_offsets[i]:text_offsets[i+1]].decode("utf-8")
+                    for i in range(text_offsets.shape[0] - 1)]
+    documents = []
+    for doc_idx, doc_id in enumerate(doc_ids):
+        start, end = doc_offsets[doc_idx], doc_offsets[doc_idx+1]
+        doc_lbl_dict = None
+        if len(doc_labels) > 0:
+            doc_lbl_dict = {lbl_name: labels[doc_idx] for lbl_name, labels in doc_labels.items()}
+        d = Document(doc_id, sentences[start:end], doc_lbl_dict=doc_lbl_dict,
+                        sentence_labels=sentence_labels[start:end])
+        d.set_sequences(tokens[start:end], fingerprint=meta["fingerprint"])
+        documents.append(d)
+
+    print("read {0} documents ({1} sentences) from {2}".format(len(documents),
+                meta["n_sentences"], cache_dir))
+    return documents, p
+
+
+if __name__ == "__main__":
+    import train_RA_CNN
+
+    parser = optparse.OptionParser()
+
+    parser.add_option('-i', '--input', dest="data_path",
+        help="formatted data (CSV, or directory of normalized data)",
+        default="data/splits/train-df.csv")
+
+    parser.add_option('-o', '--out-dir', dest="cache_dir",
+        help="where to write the cache", default="data/cache/train")
+
+    parser.add_option('--mf', '--max-features', dest="max_features",
+        help="maximum number of unique tokens", default=20000, type="int")
+
+    parser.add_option('--msl', '--max-sent-length', dest="max_sent_len",
+        help="maximum length (in tokens) of a given sentence", default=25, type="int")
+
+    parser.add_option('--mdl', '--max-doc-length', dest="max_doc_len",
+        help="maximum length (in sentences) of a given doc", default=200, type="int")
+
+    parser.add_option('--nsw', '--no-stopword', dest="stopword",
+        help="do not remove stopwords", action='store_false', default=True)
+
+    (options, args) = parser.parse_args()
+    train_RA_CNN.load_documents(options.data_path, cache_dir=options.cache_dir,
+                                    max_features=options.max_features,
+                                    max_sent_len=options.max_sent_len,
+                                    max_doc_len=options.max_doc_len,
+                                    stopword=options.stopword)
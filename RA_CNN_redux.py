@@ -6,6 +6,11 @@ RoB 2.0: including outcome-type specific decisions.
 
 from __future__ import print_function
 import pdb
+import json
+import ctypes
+import hashlib
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 from collections import defaultdict
 import sys 
 try:
@@ -39,6 +44,7 @@ from keras.preprocessing.text import text_to_word_sequence, Tokenizer
 from keras.callbacks import ModelCheckpoint, EarlyStopping
 from keras.constraints import maxnorm
 from keras.regularizers import l2
+from keras.utils import Sequence
 
 # OUTCOME_TYPES = ["all", "mortality", "objective", "subjective"]
 # 2/26 -- for now, just doing all.
@@ -65,13 +71,20 @@ class RationaleCNN:
                         sent_dropout=0.5, doc_dropout=0.5, 
                         end_to_end_train=False, f_beta=2,
                         document_model_architecture_path=None,
-                        document_model_weights_path=None):
+                        document_model_weights_path=None,
+                        bucket_width=None):
         '''
         parameters
         ---
         preprocessor: an instance of the Preprocessor class, defined below
+        bucket_width: if given, models accept documents of any length (up
+                      to max_doc_len), and documents are batched with
+                      others of similar length: lengths are rounded up 
+                      to a multiple of bucket_width sentences, rather 
+                      than padded all the way to max_doc_len.
         '''
         self.preprocessor = preprocessor
+        self.bucket_width = bucket_width
 
         if filters is None:
             self.ngram_filters = [3, 4, 5]
@@ -175,14 +188,21 @@ class RationaleCNN:
         summed_lbl_dict = np.sum(all_sent_lbl_vectors, axis=0)
         _, neg_indices = np.where([summed_lbl_dict <= 0]) 
         _, pos_indices = np.where([summed_lbl_dict > 0])
-        sampled_neg_indices = np.random.choice(neg_indices, r*pos_indices.shape[0], replace=False)
-        train_indices = np.concatenate([pos_indices, sampled_neg_indices])
 
-        if n_rows is not None:
+        if n_rows is None:
+            sampled_neg_indices = np.random.choice(neg_indices, r*pos_indices.shape[0], replace=False)
+            train_indices = np.concatenate([pos_indices, sampled_neg_indices])
+        else:
             # then we will return a matrix comprising n_rows rows, 
             # repeating positive examples but drawing diverse negative
             # instances
             num_rationale_indices = int(n_rows / 2.0)
+            if neg_indices.shape[0] == 0:
+                # (e.g., a short document, batched at its own length, 
+                # whose every sentence is a rationale)
+                num_rationale_indices = n_rows
+            elif pos_indices.shape[0] == 0:
+                num_rationale_indices = 0
             rationale_indices = np.random.choice(pos_indices, num_rationale_indices, replace=True)
 
             # sample the rest as `negative' (neutral) instances
@@ -199,7 +219,10 @@ class RationaleCNN:
             y_sent_balanced_dict[sent_lbl_type] = y_sent_lbls_dict[sent_lbl_type][doc_idx][train_indices]
 
         if sentences is not None: 
-            return X[train_indices,:], y_sent_balanced_dict, [sentences[idx] for idx in train_indices]
+            # (rows past the end of sentences are padding)
+            sampled_sentences = [sentences[idx] if idx < len(sentences) else '' 
+                                    for idx in train_indices]
+            return X[train_indices,:], y_sent_balanced_dict, sampled_sentences
 
         return X[train_indices,:], y_sent_balanced_dict
 
@@ -210,6 +233,16 @@ class RationaleCNN:
         representation of known designations (i.e., the number of unks
         in each domain is roughly balanced)
         '''
+        indices = RationaleCNN.balanced_indices_across_domains(y_doc_lbl)
+        y_doc_samples = {}
+        for domain in y_doc_lbl: 
+            y_doc_samples[domain] = y_doc_lbl[domain][indices]
+
+        return X[indices], y_doc_samples
+
+    @staticmethod
+    def balanced_indices_across_domains(y_doc_lbl):
+        ''' the (row) indices sampled by balanced_sample_across_domains '''
         ### 
         # note: y_doc_lbl is a dictionary pointing from domains to 3d 
         # one-hot label vectors
@@ -230,13 +263,7 @@ class RationaleCNN:
         for domain, domain_observed_v in domains_to_non_unks.items():
             indices.extend(np.random.choice(domain_observed_v, m))
 
-        indices = np.array(list(set(indices)))
-        y_doc_samples = {}
-        for domain in y_doc_lbl: 
-            y_doc_samples[domain] = y_doc_lbl[domain][indices]
-
-        #import pdb; pdb.set_trace()
-        return X[indices], y_doc_samples
+        return np.array(list(set(indices)))
 
 
 
@@ -290,20 +317,30 @@ class RationaleCNN:
         return X[train_indices,:], y[train_indices]
 
 
+    def _doc_len(self):
+        ''' documents (inputs) have a fixed length, unless we are bucketing '''
+        if self.bucket_width is not None:
+            return None
+        return self.preprocessor.max_doc_len
+
+    def _batches(self, corpus, doc_indices, batch_size, **kwargs):
+        return CorpusBatches(corpus, doc_indices, batch_size=batch_size, 
+                                bucket_width=self.bucket_width, **kwargs)
+
     def build_simple_doc_model(self):
         # maintains sentence structure, but does not impose weights.
         tokens_input = Input(name='input', 
-                            shape=(self.preprocessor.max_doc_len, self.preprocessor.max_sent_len), 
+                            shape=(self._doc_len(), self.preprocessor.max_sent_len), 
                             dtype='int32')
 
-        tokens_reshaped = Reshape([self.preprocessor.max_doc_len*self.preprocessor.max_sent_len])(tokens_input)
+        tokens_reshaped = Reshape([-1])(tokens_input)
 
     
         x = Embedding(self.preprocessor.max_features+1, self.preprocessor.embedding_dims, 
                         weights=self.preprocessor.init_vectors,
                         name="embedding")(tokens_reshaped)
 
-        x = Reshape((1, self.preprocessor.max_doc_len, 
+        x = Reshape((1, -1, 
                      self.preprocessor.max_sent_len*self.preprocessor.embedding_dims), 
                      name="reshape")(x)
 
@@ -324,7 +361,7 @@ class RationaleCNN:
             permuted = Permute((2,1,3), name="permuted_"+str(n_gram)) (one_max)
             
             # drop extra dimension
-            r = Reshape((self.preprocessor.max_doc_len, self.n_filters), 
+            r = Reshape((-1, self.n_filters), 
                             name="conv_"+str(n_gram))(permuted)
             
             convolutions.append(r)
@@ -367,12 +404,12 @@ class RationaleCNN:
     def build_RA_CNN_model(self, domains_to_weights=None):
         # input dim is (max_doc_len x max_sent_len) -- eliding the batch size
         tokens_input = Input(name='input', 
-                            shape=(self.preprocessor.max_doc_len, self.preprocessor.max_sent_len), 
+                            shape=(self._doc_len(), self.preprocessor.max_sent_len), 
                             dtype='int32')
         
 
         # flatten; create a very wide matrix to hand to embedding layer
-        tokens_reshaped = Reshape([self.preprocessor.max_doc_len*self.preprocessor.max_sent_len])(tokens_input)
+        tokens_reshaped = Reshape([-1])(tokens_input)
         # embed the tokens; output will be (p.max_doc_len*p.max_sent_len x embedding_dims)
         # here we should initialize with weights from sentence model embedding layer!
         # also pass weights for initialization
@@ -386,7 +423,7 @@ class RationaleCNN:
         # the 1 here is a dummy for the `channels' expected
         # by conv2d --> 
         #   (batch, channels, doc_len, (word_in_sent x embedding_dim))
-        x = Reshape((1, self.preprocessor.max_doc_len, 
+        x = Reshape((1, -1, 
                      self.preprocessor.max_sent_len*self.preprocessor.embedding_dims), 
                      name="reshape")(x)
 
@@ -407,7 +444,7 @@ class RationaleCNN:
             permuted = Permute((2,1,3), name="permuted_"+str(n_gram)) (one_max)
             
             # drop extra dimension
-            r = Reshape((self.preprocessor.max_doc_len, self.n_filters), 
+            r = Reshape((-1, self.n_filters), 
                             name="conv_"+str(n_gram))(permuted)
             
             convolutions.append(r)
@@ -529,29 +566,36 @@ class RationaleCNN:
         #import pdb; pdb.set_trace()
         return acc_dicts
 
-    def predictions_for_docs(self, docs):
-        # @TODO this is way slower then it needs to be
-        doc_predictions = []
+    def _predict(self, batches):
+        '''
+        doc model predictions (a list, with an entry per output) for 
+        CorpusBatches, in the order of their doc_indices.
+        '''
+        y_hat = self.doc_model.predict_generator(batches, steps=len(batches))
+        if not isinstance(y_hat, list):
+            # (a model with a single output)
+            y_hat = [y_hat]
+        # (batches come in order of length, if bucketed)
+        positions = batches.positions()
+        y_hat_in_order = []
+        for y_hat_o in y_hat:
+            y_hat_in_order.append(np.empty_like(y_hat_o))
+            y_hat_in_order[-1][positions] = y_hat_o
+        return y_hat_in_order
+
+    def predictions_for_docs(self, docs, batch_size=50):
+        '''
+        doc model predictions for docs: a dict per document, mapping 
+        output names to predicted label distributions. Sequences are
+        generated where this has not been done already (the usual case).
+        '''
         # this is lame
         output_names = [o.name.split("/")[0] for o in self.doc_model.outputs]
-        #for output in self.doc_model.outputs:
-        #    predictions_d[output.name] = []
-
-        for doc in docs:
-            if doc.sentence_sequences is None:
-                # this will be the usual case
-                doc.generate_sequences(self.preprocessor)
-
-            X_doc = np.array([doc.get_padded_sequences(self.preprocessor, labels_too=False)])
-            
-            #doc_pred = self.doc_model.predict(X_doc)[0][0]
-            doc_preds = self.doc_model.predict(X_doc)
-            doc_preds = dict(zip(output_names, doc_preds))
-            doc_predictions.append(doc_preds)
-            #for output_layer, pred in zip(self.doc_model.outputs, doc_preds):
-            #    predictions_d[output_layer.name].append(pred)
 
-        return doc_predictions
+        corpus = Corpus.from_documents(docs, self.preprocessor)
+        y_hat = self._predict(self._batches(corpus, np.arange(len(corpus)), batch_size))
+        return [dict((name, y_hat_o[doc_idx]) for name, y_hat_o in zip(output_names, y_hat))
+                    for doc_idx in range(len(corpus))]
 
     def predict_and_rank_sentences_for_doc(self, doc, num_rationales=3, threshold=0):
         '''
@@ -562,10 +606,6 @@ class RationaleCNN:
         if self.sentence_prob_model is None:
             self.set_final_sentence_model()
 
-        if doc.sentence_sequences is None:
-            # this will be the usual case
-            doc.generate_sequences(self.preprocessor)
-
         X_doc = np.array([doc.get_padded_sequences(self.preprocessor, labels_too=False)])
         
         # doc pred
@@ -586,14 +626,6 @@ class RationaleCNN:
 
         return (doc_pred, rationales)
 
-    @staticmethod
-    def _doc_contains_at_least_one_rationale(sentence_lbl_dicts):
-        for y_d in sentence_lbl_dicts:
-            if any([y_d_j > 0 for y_d_j in y_d.values()]):
-                return True
-
-        return False 
-
 
 
 
@@ -668,12 +700,9 @@ class RationaleCNN:
 
     def train_sentence_model(self, train_documents, nb_epoch=5, 
                                 downsample=True, 
-                                sent_val_split=.2, 
+                                sent_val_split=.2, batch_size=32,
                                 sentence_model_weights_path="sentence_model_weights.hdf5"):
 
-        # assumes sentence sequences have been generated!
-        assert(train_documents[0].sentence_sequences is not None)
-
         # for the validation split, we assume this is at the *document*
         # level to be consistent with document-level training. 
         # so if this is .1, for example, the sentences comprising the last 
@@ -682,49 +711,26 @@ class RationaleCNN:
         print("using sentences from %s docs for sentence prediction validation!" % 
                     validation_size)
     
-        # build the train and (nested!) validation sets
-        X_doc, y_sent, train_sentences = [], [], []
-
-        y_sent_lbls_dict = {}
-        for s_layer_name in self.sentence_layer_names:
-            y_sent_lbls_dict[s_layer_name] = []
-
-        for d in train_documents[:-validation_size]:
-            cur_X, cur_sent_y_dict = d.get_padded_sequences(self.preprocessor)
-            if RationaleCNN._doc_contains_at_least_one_rationale(cur_sent_y_dict):
-                X_doc.append(cur_X)
-                combined_dict = RationaleCNN._combine_dicts(cur_sent_y_dict)
-
-                for t in combined_dict:
-                    y_sent_lbls_dict[t].append(np.array(combined_dict[t]))
-
-                train_sentences.append(d.padded_sentences)
-              
-
-        X_doc = np.array(X_doc)
-        n_docs, num_sents, sent_len = X_doc.shape
-        for outcome_key in y_sent_lbls_dict.keys():
-            arr_lbls = np.array(y_sent_lbls_dict[outcome_key])
-            y_sent_lbls_dict[outcome_key] = arr_lbls.reshape(n_docs, num_sents, 1)
- 
-        X_doc_validation, y_sent_dicts_validation, validation_sentences = [], [], []
-        for d in train_documents[-validation_size:]:
-            cur_X, cur_sent_y_dict = d.get_padded_sequences(self.preprocessor)
-            # we only keep validation documents that contain at least one rationale /
-            # sentence label 
-            # @TODO this results in dropping a *lot* of docs -- needs sanity check
-            #       (or perhaps we are doing the matching poorly.)
-            if RationaleCNN._doc_contains_at_least_one_rationale(cur_sent_y_dict):
-                X_doc_validation.append(cur_X)
-                y_sent_dicts_validation.append(RationaleCNN._combine_dicts(cur_sent_y_dict))
-                validation_sentences.append(d.padded_sentences)
-
+        # build the train and (nested!) validation sets; documents are
+        # padded batch by batch, as they are fed to the model
+        train_corpus = Corpus.from_documents(train_documents[:-validation_size], self.preprocessor)
+        train_indices = np.nonzero(train_corpus.has_rationale())[0]
+
+        # we only keep validation documents that contain at least one rationale /
+        # sentence label 
+        # @TODO this results in dropping a *lot* of docs -- needs sanity check
+        #       (or perhaps we are doing the matching poorly.)
+        validation_corpus = Corpus.from_documents(train_documents[-validation_size:], 
+                                                    self.preprocessor)
+        validation_indices = np.nonzero(validation_corpus.has_rationale())[0]
         print ("using {0} docs for validation that have *any* rationale labels (out of {1} total available validation docs)".format(
-                        len(X_doc_validation), validation_size))
-        X_doc_validation = np.array(X_doc_validation)
-        y_sent_validation = RationaleCNN._combine_dicts(y_sent_dicts_validation, 
-                                                            convert_to_np_arrs=True)
+                        validation_indices.shape[0], validation_size))
+        _, y_sent_validation = validation_corpus.batch(validation_indices)
         y_sent_validation_weights = RationaleCNN._get_val_weights(y_sent_validation)
+        validation_batches = self._batches(validation_corpus, validation_indices, batch_size,
+                                            y=y_sent_validation, 
+                                            sample_weight=y_sent_validation_weights,
+                                            per_sentence=True)
 
         ##############################################################
         # we draw nb_epoch balanced samples; take one pass on each   #
@@ -738,53 +744,14 @@ class RationaleCNN:
         for iter_ in range(nb_epoch):
             print ("on epoch: %s" % iter_)
 
-            X_temp, sentences_temp = [], []
+            train_batches = BalancedSentenceBatches(train_corpus, train_indices, 
+                                                    batch_size=batch_size, shuffle=True,
+                                                    bucket_width=self.bucket_width)
+            self.sentence_model.fit_generator(train_batches, steps_per_epoch=len(train_batches), 
+                                                epochs=1)
 
-            # y_sent_temp maps sentence label types to 
-            # constructed samples
-            y_sent_temp = {}
-            for sent_lbl in y_sent_lbls_dict.keys():
-                y_sent_temp[sent_lbl] = []
-
-            for i in range(X_doc.shape[0]):
-                # i is indexing the document here!
-                X_doc_i = X_doc[i]
-
-                '''
-                A tricky bit here is that the model expects a given doc length as input,
-                so here we take a kind of hacky approach of duplicating the downsampled
-                rows per documents. Basically this assembles 'balanced' pseudo documents
-                for input to the model.
-                '''
-                n_target_rows = X_doc_i.shape[0]
-                # this will include: all positive sentences (in any domain), and then a matched sample
-                # of randomly selected negative ones.
-                X_doc_i_temp, y_sent_i_lbl_dict_temp, sampled_sentences = RationaleCNN.balanced_sample_MT(X_doc_i,
-                                                                    y_sent_lbls_dict, i, 
-                                                                    sentences=train_sentences[i],
-                                                                    n_rows=n_target_rows)
-
-                X_temp.append(X_doc_i_temp)
-                #import pdb; pdb.set_trace()
-
-                # @TODO note that there will be a pretty big imbalance here
-                # w.r.t. sentence label types (domains) that we are not 
-                # currently accounting for. may want to do stratified sampling.
-                for sent_lbl in y_sent_lbls_dict:
-                    y_sent_temp[sent_lbl].append(np.array(y_sent_i_lbl_dict_temp[sent_lbl]))
-        
-       
-                sentences_temp.append(sampled_sentences)
-
-            
-            X_temp = np.array(X_temp)
-            for sent_lbl in y_sent_lbls_dict:
-                y_sent_temp[sent_lbl] = np.array(y_sent_temp[sent_lbl])
-             
-
-            self.sentence_model.fit(X_temp, y_sent_temp, epochs=1)
-
-            cur_val_results = self.sentence_model.evaluate(X_doc_validation, y_sent_validation, sample_weight=y_sent_validation_weights)
+            cur_val_results = self.sentence_model.evaluate_generator(validation_batches, 
+                                                                        steps=len(validation_batches))
             if not (type(cur_val_results) == type([])):
               cur_val_results = [None, cur_val_results]
  
@@ -868,9 +835,9 @@ class RationaleCNN:
 
 
 
-    def doc_predict_no_unks(self, X):
-        # make predictions; lop off "unk" (last label)
-        y_hat = self.doc_model.predict(X) 
+    def doc_predict_no_unks(self, batches):
+        # make predictions (for CorpusBatches); lop off "unk" (last label)
+        y_hat = self._predict(batches)
         # now remove unk predictions
         y_hat_no_unks = []
         for y_hat_d in y_hat:
@@ -890,16 +857,9 @@ class RationaleCNN:
         ###
         # build the train set
         ###
-        X_doc, y_doc_dicts = [], []
-        y_sent = []
-        for d in train_documents[:-validation_size]:
-            cur_X, cur_sent_y = d.get_padded_sequences(self.preprocessor)
-            X_doc.append(cur_X)
-            y_doc_dicts.append(d.doc_y_dict)
-            y_sent.append(cur_sent_y)
-        X_doc = np.array(X_doc)
-        y_doc = RationaleCNN._combine_dicts(y_doc_dicts, convert_to_np_arrs=True, 
-                                                         expand_dims=False)
+        train_corpus = Corpus.from_documents(train_documents[:-validation_size], self.preprocessor)
+        train_indices = np.arange(len(train_corpus))
+        y_doc = train_corpus.doc_label_dict(train_indices)
         domains_to_weights = RationaleCNN.get_per_domain_weights(y_doc)
 
         
@@ -908,17 +868,11 @@ class RationaleCNN:
         # @TODO refactor (rather redundant with above...)
         # and the validation set. 
         ####
-        X_doc_validation, y_doc_validation_dicts = [], []
-        y_sent_validation = []
-        for d in train_documents[-validation_size:]:
-            cur_X, cur_sent_y = d.get_padded_sequences(self.preprocessor)
-            X_doc_validation.append(cur_X)
-            y_doc_validation_dicts.append(d.doc_y_dict)
-            y_sent_validation.append(cur_sent_y)
-        X_doc_validation = np.array(X_doc_validation)
-        y_doc_validation = RationaleCNN._combine_dicts(y_doc_validation_dicts, 
-                                                        convert_to_np_arrs=True, 
-                                                        expand_dims=False)
+        validation_corpus = Corpus.from_documents(train_documents[-validation_size:], 
+                                                    self.preprocessor)
+        validation_indices = np.arange(len(validation_corpus))
+        y_doc_validation = validation_corpus.doc_label_dict(validation_indices)
+        validation_batches = self._batches(validation_corpus, validation_indices, batch_size)
 
 
         
@@ -942,11 +896,14 @@ class RationaleCNN:
                 print ("on epoch: %s" % iter_)
 
                 
-                X_tmp, y_tmp = RationaleCNN.balanced_sample_across_domains(X_doc, y_doc)
-                
+                sample_indices = RationaleCNN.balanced_indices_across_domains(y_doc)
+                y_tmp = train_corpus.doc_label_dict(sample_indices)
 
                 doc_weights_tmp = RationaleCNN.get_sample_weights_for_docs(y_tmp, domains_to_weights)
-                self.doc_model.fit(X_tmp, y_tmp, batch_size=batch_size, epochs=1, sample_weight=doc_weights_tmp)
+                sample_batches = self._batches(train_corpus, sample_indices, batch_size,
+                                                y=y_tmp, sample_weight=doc_weights_tmp, shuffle=True)
+                self.doc_model.fit_generator(sample_batches, steps_per_epoch=len(sample_batches), 
+                                                epochs=1)
                                          #class_weight={0:1, 1:pos_class_weight})
 
                 '''
@@ -954,12 +911,8 @@ class RationaleCNN:
                 '''
                 
 
-                y_hat = self.doc_model.predict(X_doc_validation)
-
                 # drop any unk predictions!
-                
-
-                y_hat = self.doc_predict_no_unks(X_doc_validation)
+                y_hat = self.doc_predict_no_unks(validation_batches)
 
                 # need to force pred of either 0/1 -- i.e., no predicting 'unk'!
 
@@ -1008,20 +961,44 @@ class RationaleCNN:
             doc_val_weights = RationaleCNN.get_sample_weights_for_docs(y_doc_validation)#, domains_to_weights)
             doc_weights = RationaleCNN.get_sample_weights_for_docs(y_doc, domains_to_weights)
             import pdb; pdb.set_trace()
-            hist = self.doc_model.fit(X_doc, y_doc, 
+            train_batches = self._batches(train_corpus, train_indices, batch_size,
+                                            y=y_doc, sample_weight=doc_weights, shuffle=True)
+            validation_batches = self._batches(validation_corpus, validation_indices, batch_size,
+                                                y=y_doc_validation, sample_weight=doc_val_weights)
+            hist = self.doc_model.fit_generator(train_batches, 
+                        steps_per_epoch=len(train_batches),
                         epochs=nb_epoch, 
-                        validation_data=(X_doc_validation, y_doc_validation, doc_val_weights),
-                        sample_weight=doc_weights,
-                        callbacks=[checkpointer],
-                        batch_size=batch_size)
+                        validation_data=validation_batches,
+                        validation_steps=len(validation_batches),
+                        callbacks=[checkpointer])
 
 
         # reload best weights
         self.doc_model.load_weights(document_model_weights_path)
 
 class Document:
+    '''
+    A document's sentences and their labels. Sentence labels are held as
+    a (sentences x SENT_OUTCOMES) array, and the sentence sequences (once
+    generated) as a (sentences x max_sent_len) array, which may well be
+    a view of a larger (e.g., cached) one; padding to max_doc_len is done
+    on request, into a buffer the caller may provide.
+
+    Sequences are generated lazily by get_sequences, and kept for each
+    preprocessor (fingerprint) they were generated by; so a document can
+    be used with several models without being re-tokenized, or being
+    fed stale sequences.
+    '''
+    __slots__ = ["doc_id", "doc_y_dict", "sentences", "sentence_labels", 
+                    "sentence_sequences", "n", "_sequences"]
+
     def __init__(self, doc_id, sentences, doc_lbl_dict=None, 
-                    sentence_lbl_dicts=None, min_sent_len=3):
+                    sentence_lbl_dicts=None, min_sent_len=3, sentence_labels=None):
+        '''
+        Sentence labels may be given either as sentence_lbl_dicts (one
+        dict, mapping SENT_OUTCOMES to labels, per sentence) or as an
+        array sentence_labels (sentences x SENT_OUTCOMES).
+        '''
         self.doc_id = doc_id
         self.doc_y_dict = doc_lbl_dict
 
@@ -1031,27 +1008,36 @@ class Document:
         # said sentence constitutes a rationale for the respective
         # domain RoB judgments.
         ###
-        self.sentences, self.sentence_y_dicts = [], []
-        for idx, s in enumerate(sentences):
-            if len(s.split(" ")) >= min_sent_len:
-                self.sentences.append(s)
-                if not sentence_lbl_dicts is None:
-                    #sent_y_vec = sent_lbl_dict_to_vec(sentences_labels[idx])
-                    #self.sentences_y_vects.append(sentences_labels[idx])
-                    self.sentence_y_dicts.append(sentence_lbl_dicts[idx])
-
+        keep = [idx for idx, s in enumerate(sentences) if len(s.split(" ")) >= min_sent_len]
+        self.sentences = [sentences[idx] for idx in keep]
+
+        if sentence_labels is None and sentence_lbl_dicts is not None:
+            sentence_labels = [[y_d[sj] for sj in SENT_OUTCOMES] for y_d in sentence_lbl_dicts]
+        self.sentence_labels = None
+        if sentence_labels is not None:
+            sentence_labels = np.asarray(sentence_labels, dtype=np.float32).reshape(
+                                                    len(sentences), len(SENT_OUTCOMES))
+            if len(keep) < len(sentences):
+                sentence_labels = sentence_labels[keep]
+            self.sentence_labels = sentence_labels
+
+        # the sequences most recently used, and all those generated, by
+        # preprocessor fingerprint
         self.sentence_sequences = None
+        self._sequences = {}
         # length, pre-padding!
-        self.num_sentences = len(self.sentences)
-
-        self.sentence_weights = None 
-        self.sentence_idx = 0
         self.n = len(self.sentences)
 
+    @property
+    def num_sentences(self):
+        return self.n
 
-    def get_padded_sentences():
-        # sometimes useful for indexing purposes
-        return self.padded_sentences
+    @property
+    def sentence_y_dicts(self):
+        ''' per-sentence label dicts (as Documents used to hold them) '''
+        if self.sentence_labels is None:
+            return []
+        return [dict(zip(SENT_OUTCOMES, labels)) for labels in self.sentence_labels]
 
     def __len__(self):
         return self.n 
@@ -1062,55 +1048,403 @@ class Document:
         elsewhere! this will be used to map sentences to 
         integer sequences here.
         '''
-        self.sentence_sequences = p.build_sequences(self.sentences)
-        self.padded_sentences = self.sentences + [''] * (p.max_doc_len - self.n)
-
-
-    def get_padded_sequences_for_X_y(self, p, X, y_dicts):
-        n_sentences = X.shape[0]
-        y = None
-        if n_sentences > p.max_doc_len:
-            X = X[:p.max_doc_len]
-            y = y_dicts[:p.max_doc_len]
-        elif n_sentences <= p.max_doc_len:
-            dummy_rows = 0 * np.ones((p.max_doc_len-n_sentences, p.max_sent_len), dtype='int32')
-            X = np.vstack((X, dummy_rows))
-        
-            # for padded rows (which represent sentences), create all-zero label dictionaries
-            dummy_sent_lbl_dict = {}
-            for sent_output_name in SENT_OUTCOMES:
-                cur_sent_layer_name = "{0}".format(sent_output_name)
-                dummy_sent_lbl_dict[cur_sent_layer_name] = 0.0 
-
-            dummy_lbls = [dummy_sent_lbl_dict]*(p.max_doc_len-n_sentences)
-            y = y_dicts + dummy_lbls
-            
+        self.set_sequences(p.build_sequences(self.sentences), fingerprint=p.fingerprint())
 
-        return np.array(X), y
+    def set_sequences(self, sentence_sequences, fingerprint=None):
+        '''
+        use sequences generated elsewhere, e.g. read from a cache, by a
+        preprocessor with the given fingerprint
+        '''
+        self.sentence_sequences = sentence_sequences
+        if fingerprint is not None:
+            self._sequences[fingerprint] = sentence_sequences
+
+    def get_sequences(self, p):
+        ''' sentence sequences as generated by p (generating them if need be) '''
+        sentence_sequences = self._sequences.get(p.fingerprint())
+        if sentence_sequences is None:
+            self.generate_sequences(p)
+        else:
+            self.sentence_sequences = sentence_sequences
+        return self.sentence_sequences
 
-    def get_padded_sequences_for_X(self, p, X):
-        n_sentences = X.shape[0]
-        if n_sentences > p.max_doc_len:
-            X = X[:p.max_doc_len]
-        elif n_sentences < p.max_doc_len:
-            # pad
-            #dummy_rows = p.max_features * np.ones((p.max_doc_len-n_sentences, p.max_sent_len), dtype='int32') 
-            dummy_rows = 0 * np.ones((p.max_doc_len-n_sentences, p.max_sent_len), dtype='int32')
-            X = np.vstack((X, dummy_rows))
-        return np.array(X)
+    def has_rationale(self, max_doc_len):
+        ''' does any of the first max_doc_len sentences have a positive label? '''
+        if self.sentence_labels is None:
+            return False
+        return bool((self.sentence_labels[:max_doc_len] > 0).any())
 
+    def get_padded_sequences_for_X(self, p, X=None):
+        '''
+        sentence sequences, truncated or padded (with all-zero rows) to
+        p.max_doc_len; X, a (max_doc_len x max_sent_len) int32 buffer, is 
+        filled in if given.
+        '''
+        n = min(self.n, p.max_doc_len)
+        if X is None:
+            X = np.zeros((p.max_doc_len, p.max_sent_len), dtype='int32')
+        else:
+            X[n:] = 0
+        X[:n] = self.get_sequences(p)[:n]
+        return X
 
-    def get_padded_sequences(self, p, labels_too=True):
-        # return p.build_sequences(self.sentences, pad_documents=True)              
-        #n_sentences = self.sentence_sequences.shape[0]
-        X = self.sentence_sequences
+    def get_padded_labels(self, p, y=None):
+        '''
+        sentence labels, truncated or padded (for padded rows, which
+        represent sentences, all labels are 0) to p.max_doc_len; y, a 
+        (max_doc_len x SENT_OUTCOMES) buffer, is filled in if given.
+        '''
+        n = min(self.n, p.max_doc_len)
+        if y is None:
+            y = np.zeros((p.max_doc_len, len(SENT_OUTCOMES)), dtype=np.float32)
+        else:
+            y[n:] = 0
+        if self.sentence_labels is not None:
+            y[:n] = self.sentence_labels[:n]
+        return y
 
+    def get_padded_sequences(self, p, labels_too=True, X=None):
+        X = self.get_padded_sequences_for_X(p, X=X)
         if labels_too:    
-            y_dicts = self.sentence_y_dicts
-            return self.get_padded_sequences_for_X_y(p, X, y_dicts)
+            y = self.get_padded_labels(p)
+            return X, dict(zip(SENT_OUTCOMES, y.T))
 
         # otherwise only return X
-        return self.get_padded_sequences_for_X(p, X)
+        return X
+
+def _ranges(counts):
+    ''' concatenated np.arange(c) for each c in counts '''
+    counts = np.asarray(counts, dtype=np.int64)
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+class Corpus:
+    '''
+    The sentence sequences (and labels) of a collection of documents,
+    stored ragged, CSR style: the tokens of all sentences, unpadded, in
+    one flat array, with the offsets of each sentence's tokens in it and
+    of each document's sentences. Documents are only padded (to 
+    max_doc_len sentences of max_sent_len tokens) when a batch of them
+    is assembled, so memory use grows with the number of tokens in the
+    corpus rather than with documents x max_doc_len x max_sent_len.
+    '''
+
+    def __init__(self, tokens, token_offsets, doc_offsets, sentence_labels, doc_labels,
+                    max_sent_len, max_doc_len):
+        self.tokens = tokens
+        self.token_offsets = token_offsets
+        self.doc_offsets = doc_offsets
+        self.sentence_labels = sentence_labels
+        # output name -> (documents x 3) one-hot labels
+        self.doc_labels = doc_labels
+        self.max_sent_len = max_sent_len
+        self.max_doc_len = max_doc_len
+
+    @classmethod
+    def from_documents(cls, documents, p):
+        '''
+        Corpus of the documents' sequences, as generated by p (see
+        Document.get_sequences).
+        '''
+        tokens, lengths, sentence_labels = [], [], []
+        for d in documents:
+            # sequences are pre-padded with 0, which is never a token 
+            # index; so the tokens are just the non-zero entries
+            sentence_sequences = np.asarray(d.get_sequences(p))
+            is_token = sentence_sequences != 0
+            tokens.append(sentence_sequences[is_token])
+            lengths.append(is_token.sum(axis=1))
+            if d.sentence_labels is None:
+                sentence_labels.append(np.zeros((d.n, len(SENT_OUTCOMES)), dtype=np.float32))
+            else:
+                sentence_labels.append(d.sentence_labels)
+
+        doc_labels = {}
+        if len(documents) > 0 and documents[0].doc_y_dict is not None:
+            for lbl_name in documents[0].doc_y_dict:
+                doc_labels[lbl_name] = np.vstack([d.doc_y_dict[lbl_name] for d in documents])
+
+        def concat(arrays, dtype, shape=(0,)):
+            if len(arrays) == 0:
+                return np.zeros(shape, dtype=dtype)
+            return np.concatenate(arrays).astype(dtype, copy=False)
+
+        lengths = concat(lengths, np.int64)
+        token_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        doc_offsets = np.concatenate([[0], np.cumsum([d.n for d in documents])]).astype(np.int64)
+        return cls(concat(tokens, np.int32), token_offsets, doc_offsets,
+                    concat(sentence_labels, np.float32, shape=(0, len(SENT_OUTCOMES))),
+                    doc_labels, p.max_sent_len, p.max_doc_len)
+
+    def __len__(self):
+        return self.doc_offsets.shape[0] - 1
+
+    def doc_lengths(self):
+        ''' number of sentences in each document (before truncation) '''
+        return np.diff(self.doc_offsets)
+
+    def has_rationale(self):
+        '''
+        For each document, does any of its first max_doc_len sentences
+        have a positive label?
+        '''
+        lengths = self.doc_lengths()
+        doc_of_sentence = np.repeat(np.arange(len(self)), lengths)
+        positive = (self.sentence_labels > 0).any(axis=1) & (_ranges(lengths) < self.max_doc_len)
+        return np.bincount(doc_of_sentence, weights=positive, minlength=len(self)) > 0
+
+    def bucket_lengths(self, doc_indices, bucket_width):
+        '''
+        The padded length of each of the documents when batched by
+        length: its number of sentences (at most max_doc_len) rounded up 
+        to a multiple of bucket_width (again, at most max_doc_len).
+        '''
+        n_sentences = np.clip(self.doc_lengths()[doc_indices], 1, self.max_doc_len)
+        return np.minimum(-(-n_sentences // bucket_width) * bucket_width, self.max_doc_len)
+
+    def batch(self, doc_indices, sentence_labels=True, doc_len=None):
+        '''
+        (len(doc_indices) x doc_len x max_sent_len) token tensor of the 
+        given documents, padded exactly as Document.get_padded_sequences
+        pads them (to doc_len rather than max_doc_len, if given) and, if
+        sentence_labels, a dict mapping sentence outputs to 
+        (len(doc_indices) x doc_len x 1) label tensors.
+        '''
+        doc_indices = np.asarray(doc_indices, dtype=np.int64)
+        sent_len = self.max_sent_len
+        if doc_len is None:
+            doc_len = self.max_doc_len
+
+        # the sentences in the batch (truncated to doc_len per
+        # document), and the rows they go to
+        starts = self.doc_offsets[doc_indices]
+        n_sentences = np.minimum(self.doc_offsets[doc_indices + 1] - starts, doc_len)
+        sentence_ids = np.repeat(starts, n_sentences) + _ranges(n_sentences)
+        rows = np.repeat(np.arange(doc_indices.shape[0]) * doc_len, n_sentences) + _ranges(n_sentences)
+
+        # pre-padding: the tokens of a sentence go at the end of its row
+        ends = self.token_offsets[sentence_ids + 1]
+        lengths = ends - self.token_offsets[sentence_ids]
+        X = np.zeros((doc_indices.shape[0] * doc_len, sent_len), dtype='int32')
+        X[np.repeat(rows, lengths), np.repeat(sent_len - lengths, lengths) + _ranges(lengths)] = \
+            self.tokens[np.repeat(ends - lengths, lengths) + _ranges(lengths)]
+        X = X.reshape(doc_indices.shape[0], doc_len, sent_len)
+        if not sentence_labels:
+            return X
+
+        y = np.zeros((doc_indices.shape[0] * doc_len, len(SENT_OUTCOMES)), dtype=np.float32)
+        y[rows] = self.sentence_labels[sentence_ids]
+        y = y.reshape(doc_indices.shape[0], doc_len, len(SENT_OUTCOMES))
+        return X, dict((sent_output_name, y[:, :, [j]]) 
+                            for j, sent_output_name in enumerate(SENT_OUTCOMES))
+
+    def doc_label_dict(self, doc_indices):
+        return dict((lbl_name, labels[doc_indices]) for lbl_name, labels in self.doc_labels.items())
+
+
+class CorpusBatches(Sequence):
+    '''
+    Batches of documents (doc_indices) from a Corpus, assembled on the
+    fly, for fit_generator and friends. Batches are X, or (X, y) or 
+    (X, y, sample_weight) when y and sample_weight (dicts mapping outputs
+    to arrays aligned with doc_indices) are given.
+
+    If bucket_width is given, each batch holds documents of the same
+    bucket length (see Corpus.bucket_lengths) and is only padded to that
+    length; batches then do not follow the order of doc_indices (see
+    positions). If per_sentence, y and sample_weight are per sentence 
+    (padded to max_doc_len, as by Corpus.batch), and are cut to the 
+    length of each batch likewise.
+    '''
+
+    def __init__(self, corpus, doc_indices, batch_size=50, y=None, sample_weight=None, 
+                    shuffle=False, bucket_width=None, per_sentence=False):
+        self.corpus = corpus
+        self.doc_indices = np.asarray(doc_indices, dtype=np.int64)
+        self.batch_size = batch_size
+        self.y = y 
+        self.sample_weight = sample_weight
+        self.shuffle = shuffle
+        self.bucket_width = bucket_width
+        self.per_sentence = per_sentence
+        self.order = np.arange(self.doc_indices.shape[0])
+        self._make_batches()
+
+    def _make_batches(self):
+        ''' (positions in doc_indices, padded length) of each batch '''
+        if self.shuffle:
+            np.random.shuffle(self.order)
+        if self.bucket_width is None:
+            buckets = [(self.order, self.corpus.max_doc_len)]
+        else:
+            lengths = self.corpus.bucket_lengths(self.doc_indices[self.order], self.bucket_width)
+            buckets = [(self.order[lengths == length], length) for length in np.unique(lengths)]
+
+        self.batches = []
+        for positions, length in buckets:
+            for start in range(0, positions.shape[0], self.batch_size):
+                self.batches.append((positions[start:start+self.batch_size], length))
+        if self.shuffle and self.bucket_width is not None:
+            # (mix up the buckets, too)
+            self.batches = [self.batches[i] for i in np.random.permutation(len(self.batches))]
+
+    def positions(self):
+        ''' positions (in doc_indices) of the documents, in the order they are batched '''
+        if len(self.batches) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([positions for positions, _ in self.batches])
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, batch_idx):
+        positions, length = self.batches[batch_idx]
+        X = self.corpus.batch(self.doc_indices[positions], sentence_labels=False, doc_len=length)
+        if self.y is None:
+            return X
+        y = dict((name, self._rows(v, positions, length)) for name, v in self.y.items())
+        if self.sample_weight is None:
+            return X, y
+        return X, y, dict((name, self._rows(w, positions, length)) 
+                            for name, w in self.sample_weight.items())
+
+    def _rows(self, v, positions, length):
+        if self.per_sentence:
+            # (sentences past length are all padding)
+            return v[positions, :length]
+        return v[positions]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._make_batches()
+
+
+class BalancedSentenceBatches(CorpusBatches):
+    '''
+    Batches of 'balanced' pseudo documents (see 
+    RationaleCNN.balanced_sample_MT) for training the sentence model; 
+    a fresh sample is drawn every time a batch is requested.
+    '''
+
+    def __getitem__(self, batch_idx):
+        positions, length = self.batches[batch_idx]
+        X, y = self.corpus.batch(self.doc_indices[positions], doc_len=length)
+        for i in range(X.shape[0]):
+            '''
+            A tricky bit here is that the model expects a given doc length as input,
+            so here we take a kind of hacky approach of duplicating the downsampled
+            rows per documents. Basically this assembles 'balanced' pseudo documents
+            for input to the model.
+            '''
+            # this will include: all positive sentences (in any domain), and then a matched sample
+            # of randomly selected negative ones.
+            X[i], y_i = RationaleCNN.balanced_sample_MT(X[i], y, i, n_rows=X.shape[1])
+            # @TODO note that there will be a pretty big imbalance here
+            # w.r.t. sentence label types (domains) that we are not 
+            # currently accounting for. may want to do stratified sampling.
+            for sent_lbl in y:
+                y[sent_lbl][i] = y_i[sent_lbl]
+        return X, y
+
+
+class SentenceEncoder:
+    '''
+    Maps sentences to token index sequences, exactly as 
+    Preprocessor.remove_stopwords, Tokenizer.texts_to_sequences and
+    pad_sequences (padding and truncating at the start) together do, 
+    but in a single pass: each distinct raw (space separated) token is 
+    stopworded, normalized and looked up in the vocabulary once, after 
+    which its indices are simply copied.
+    '''
+
+    def __init__(self, word_index, max_sent_len, num_words=None, stopwords=None,
+                    filters='!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n', lower=True):
+        '''
+        stopwords: None, if not stopwording; otherwise a collection of 
+                    (case-sensitive) raw tokens to drop.
+        '''
+        self.word_index = word_index
+        self.max_sent_len = max_sent_len
+        self.num_words = num_words
+        self.stopwords = None if stopwords is None else set(stopwords)
+        self.translate_map = str.maketrans(filters, " " * len(filters))
+        self.lower = lower
+        # raw token -> tuple of token indices
+        self.token_ids = {}
+
+    def _ids(self, raw_token):
+        if self.stopwords is not None:
+            if raw_token in self.stopwords:
+                return ()
+            if raw_token.isdigit():
+                raw_token = "numbernumbernumber"
+        if self.lower:
+            raw_token = raw_token.lower()
+        ids = []
+        for w in raw_token.translate(self.translate_map).split(" "):
+            i = self.word_index.get(w) if w else None
+            if i is not None and not (self.num_words and i >= self.num_words):
+                ids.append(i)
+        return tuple(ids)
+
+    def encode(self, texts, out=None):
+        '''
+        (len(texts) x max_sent_len) int32 matrix of the (pre-padded) 
+        sequences of texts; this is written to out, if given.
+        '''
+        token_ids, max_sent_len = self.token_ids, self.max_sent_len
+        ids, lengths = [], []
+        for text in texts:
+            start = len(ids)
+            for raw_token in text.split(" "):
+                raw_ids = token_ids.get(raw_token)
+                if raw_ids is None:
+                    raw_ids = token_ids[raw_token] = self._ids(raw_token)
+                ids.extend(raw_ids)
+            if len(ids) - start > max_sent_len:
+                # (keep the last max_sent_len tokens)
+                del ids[start:len(ids) - max_sent_len]
+            lengths.append(len(ids) - start)
+
+        lengths = np.array(lengths, dtype=np.int64)
+        if out is None:
+            out = np.zeros((lengths.shape[0], max_sent_len), dtype=np.int32)
+        else:
+            out[:] = 0
+        out[np.repeat(np.arange(lengths.shape[0]), lengths), 
+                np.repeat(max_sent_len - lengths, lengths) + _ranges(lengths)] = ids
+        return out
+
+
+# per-process state of Preprocessor.encode_documents' workers
+_encode_worker = {}
+
+
+def _init_encode_worker(encoder, sentences, shared, shape):
+    _encode_worker["encoder"] = encoder
+    _encode_worker["sentences"] = sentences
+    _encode_worker["X"] = np.frombuffer(shared, dtype=np.int32).reshape(shape)
+
+
+def _encode_chunk(bounds):
+    start, end = bounds
+    _encode_worker["encoder"].encode(_encode_worker["sentences"][start:end], 
+                                        out=_encode_worker["X"][start:end])
+
+
+def _word_vector_rows(wvs, words):
+    '''
+    Row (in wvs.syn0) of the vector of each of the words, or -1 if it
+    has none; wvs may be gensim KeyedVectors or RA_CNN_vectors.WordVectors.
+    '''
+    vocab = getattr(wvs, "vocab", None)
+    if vocab is not None:
+        # gensim (word -> Vocab(index, count))
+        rows = [vocab[w].index if w in vocab else -1 for w in words]
+    else:
+        rows = [wvs.index.get(w, -1) for w in words]
+    return np.array(rows, dtype=np.int64)
+
 
 class Preprocessor:
     def __init__(self, max_features, max_sent_len, embedding_dims=200, wvs=None, 
@@ -1124,6 +1458,8 @@ class Preprocessor:
 
         self.max_features = max_features  
         self.tokenizer = Tokenizer(num_words=self.max_features)#num_words=self.max_features)
+        self._vocab_sha1 = None
+        self._encoder = None
         self.max_sent_len = max_sent_len  # the max sentence length! 
         self.max_doc_len = max_doc_len # w.r.t. number of sentences!
 
@@ -1147,6 +1483,7 @@ class Preprocessor:
 
 
     def remove_stopwords(self, texts):
+        stopwords = set(self.stopwords)
         stopworded_texts = []
         for text in texts: 
             # note the naive segmentation; although this is same as the 
@@ -1154,7 +1491,7 @@ class Preprocessor:
             #stopworded_text = " ".join([t for t in text.split(" ") if not t.lower() in self.stopwords])
             stopworded_text = []
             for t in text.split(" "):
-                if not t in self.stopwords:
+                if not t in stopwords:
                     if t.isdigit():
                         t = "numbernumbernumber"
                     stopworded_text.append(t)
@@ -1184,11 +1521,54 @@ class Preprocessor:
     def fit_tokenizer(self):
         ''' Fits tokenizer to all raw texts; remembers indices->words mappings. '''
         self.tokenizer.fit_on_texts(self.processed_texts)
+        self._vocab_sha1 = None
         self.word_indices_to_words = {}
         for token, idx in self.tokenizer.word_index.items():
             self.word_indices_to_words[idx] = token
 
 
+    def set_vocabulary(self, word_index):
+        ''' Use a previously fit vocabulary (token -> index) instead of fitting the tokenizer. '''
+        self.tokenizer.word_index = dict(word_index)
+        self._vocab_sha1 = None
+        self.word_indices_to_words = {}
+        for token, idx in self.tokenizer.word_index.items():
+            self.word_indices_to_words[idx] = token
+
+
+    def vocabulary(self):
+        ''' the tokens that get (initial) embeddings; see init_word_vectors '''
+        return [t for t, token_idx in self.tokenizer.word_index.items() 
+                    if token_idx <= self.max_features]
+
+    def set_word_vectors(self, wvs):
+        '''
+        Initialize embeddings with (pre-trained) word vectors wvs, after
+        the tokenizer has been fit; wvs need only cover vocabulary().
+        '''
+        self.use_pretrained_embeddings = True
+        self.embedding_dims = wvs.syn0.shape[1]
+        self.word_embeddings = wvs
+        self.init_word_vectors()
+
+    def fingerprint(self):
+        '''
+        Identifies the sequences build_sequences produces: a hash of the
+        vocabulary and of the settings that affect tokenization.
+        '''
+        # (hashing the vocabulary is the expensive bit, so is done once)
+        if getattr(self, "_vocab_sha1", None) is None:
+            word_index = getattr(self.tokenizer, "word_index", {})
+            vocab = json.dumps(sorted(word_index.items()), ensure_ascii=False)
+            self._vocab_sha1 = hashlib.sha1(vocab.encode("utf-8")).hexdigest()
+
+        settings = [self.max_features, self.max_sent_len, self.max_doc_len, self.stopword,
+                    sorted(self.stopwords) if self.stopword else None, self.tokenizer.num_words,
+                    self.tokenizer.filters, self.tokenizer.lower, self.tokenizer.split]
+        settings = json.dumps(settings, ensure_ascii=False) + self._vocab_sha1
+        return hashlib.sha1(settings.encode("utf-8")).hexdigest()
+
+
     def decode(self, x):
         ''' For convenience; map from word index vector to words'''
         words = []
@@ -1199,7 +1579,82 @@ class Preprocessor:
                 words.append(self.word_indices_to_words[t_idx])
         return " ".join(words) 
 
-    def build_sequences(self, texts, pad_documents=False):
+    def __getstate__(self):
+        # (the encoder is rebuilt on demand; no need to pickle its memo)
+        state = self.__dict__.copy()
+        state["_encoder"] = None
+        return state
+
+    def encoder(self):
+        ''' the SentenceEncoder for the current vocabulary and settings '''
+        fingerprint = self.fingerprint()
+        encoder = getattr(self, "_encoder", None)
+        if encoder is None or encoder.fingerprint != fingerprint:
+            encoder = SentenceEncoder(self.tokenizer.word_index, self.max_sent_len, 
+                                        num_words=self.tokenizer.num_words, 
+                                        stopwords=self.stopwords if self.stopword else None,
+                                        filters=self.tokenizer.filters, 
+                                        lower=self.tokenizer.lower)
+            encoder.fingerprint = fingerprint
+            self._encoder = encoder
+        return encoder
+
+    def _can_encode(self):
+        # (the encoder only mimics the tokenizer with these settings)
+        return (self.tokenizer.split == " " and not getattr(self.tokenizer, "char_level", False) 
+                    and getattr(self.tokenizer, "oov_token", None) is None)
+
+    def build_sequences(self, texts, pad_documents=False, out=None):
+        '''
+        (len(texts) x max_sent_len) int32 matrix of token index sequences
+        (written to out, if given).
+        '''
+        if not self._can_encode():
+            X = self.keras_build_sequences(texts)
+            if out is not None:
+                out[:] = X
+                X = out
+            return X
+        return self.encoder().encode(texts, out=out)
+
+    def encode_documents(self, documents, n_jobs=None, chunk_size=5000):
+        '''
+        Generate the sentence sequences of all of the documents at once,
+        in n_jobs processes (by default, one per core), and attach them 
+        to the documents (see Document.set_sequences). The sequences are
+        views of a single (sentences x max_sent_len) matrix, which is 
+        returned. Workers write their chunks of it straight to shared 
+        memory, so only chunk bounds are passed back and forth.
+        '''
+        sentences = [s for d in documents for s in d.sentences]
+        offsets = np.concatenate([[0], np.cumsum([d.n for d in documents])]).astype(np.int64)
+        shape = (len(sentences), self.max_sent_len)
+        chunks = [(start, min(start + chunk_size, shape[0])) 
+                        for start in range(0, shape[0], chunk_size)]
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+
+        if n_jobs <= 1 or len(chunks) <= 1 or not self._can_encode():
+            X = self.build_sequences(sentences)
+        else:
+            shared = RawArray(ctypes.c_int32, shape[0] * shape[1])
+            X = np.frombuffer(shared, dtype=np.int32).reshape(shape)
+            pool = multiprocessing.Pool(min(n_jobs, len(chunks)), initializer=_init_encode_worker, 
+                                        initargs=(self.encoder(), sentences, shared, shape))
+            try:
+                pool.map(_encode_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+            print("encoded {0} sentences in {1} processes".format(shape[0], min(n_jobs, len(chunks))))
+
+        fingerprint = self.fingerprint()
+        for doc_idx, d in enumerate(documents):
+            d.set_sequences(X[offsets[doc_idx]:offsets[doc_idx+1]], fingerprint=fingerprint)
+        return X
+
+    def keras_build_sequences(self, texts):
+        ''' build_sequences, the slow way: using the Keras tokenizer directly '''
         processed_texts = texts 
         if self.stopword:
             processed_texts = self.remove_stopwords(texts)
@@ -1211,27 +1666,38 @@ class Preprocessor:
 
         return X
 
-    def init_word_vectors(self):
+    def init_word_vectors(self, seed=1337):
         ''' 
-        Initialize word vectors.
+        Initialize word vectors: a (max_features+1 x embedding_dims) 
+        matrix, whose row i is the (initial) embedding of the token with
+        index i, as the Embedding layer looks them up. Row 0 (padding)
+        is all zeros, tokens with pre-trained vectors get these, and the
+        others random ones (uniform in [-1, 1], drawn with seed).
         '''
-        self.init_vectors = []
-        unknown_words_to_vecs = {}
+        n_rows = self.max_features + 1
+        tokens, token_indices = [], []
         for t, token_idx in self.tokenizer.word_index.items():
-            if token_idx <= self.max_features:
-                try:
-                    self.init_vectors.append(self.word_embeddings[t])
-                except:
-                    if t not in unknown_words_to_vecs:
-                        # randomly initialize
-                        unknown_words_to_vecs[t] = np.random.random(
-                                                self.embedding_dims)*-2 + 1
-
-                    self.init_vectors.append(unknown_words_to_vecs[t])
-
-        # init padding token!
-        self.init_vectors.append(np.zeros(self.embedding_dims))
+            if token_idx < n_rows:
+                tokens.append(t)
+                token_indices.append(token_idx)
+        token_indices = np.array(token_indices, dtype=np.int64)
+
+        # a single (indexed) read of all the vectors we have
+        rows = _word_vector_rows(self.word_embeddings, tokens)
+        known = rows >= 0
+        init_vectors = np.zeros((n_rows, self.embedding_dims), dtype=np.float32)
+        init_vectors[token_indices[known]] = self.word_embeddings.syn0[rows[known]]
+
+        # randomly initialize the rest
+        n_unknown = int((~known).sum())
+        random_state = np.random.RandomState(seed)
+        init_vectors[token_indices[~known]] = random_state.random_sample(
+                                                (n_unknown, self.embedding_dims)) * -2 + 1
+
+        print("initialized {0} word vectors: {1} ({2:.1f}%) pre-trained, {3} random".format(
+                    len(tokens), len(tokens) - n_unknown, 
+                    100.0 * (len(tokens) - n_unknown) / max(len(tokens), 1), n_unknown))
 
         # note that we make this a singleton list because that's
         # what Keras wants. 
-        self.init_vectors = [np.vstack(self.init_vectors)]
+        self.init_vectors = [init_vectors]
@@ -0,0 +1,111 @@
+'''
+Pre-trained word vectors, converted once from word2vec's binary format
+into a directory of files that can be memory mapped:
+
+    meta.json       source file, number of words and dimensions
+    words.json      the words, in row order
+    vectors.npy     (words x dimensions) float32 vectors
+
+Reading the full (PubMed) word2vec binary with gensim takes minutes,
+and several GB of memory, while the model only needs the vectors of
+the (at most max_features) words in its vocabulary. load_vectors reads
+just those rows from the memory mapped vectors.
+
+Usage:
+
+    python RA_CNN_vectors.py -i PubMed-w2v.bin -o data/PubMed-w2v
+
+after which data/PubMed-w2v can be used as the word_vectors_path.
+'''
+
+import os
+import json
+import optparse
+
+import numpy as np
+
+META_FILE = "meta.json"
+
+
+class WordVectors:
+    '''
+    Word vectors (a words x dimensions matrix, syn0) with as much of
+    gensim's KeyedVectors interface as the Preprocessor uses:
+    vector_size, `word in wvs' and wvs[word] (a KeyError if word is not
+    in the vocabulary).
+    '''
+
+    def __init__(self, words, syn0):
+        self.index = dict((word, row) for row, word in enumerate(words))
+        self.syn0 = syn0
+        self.vector_size = syn0.shape[1]
+
+    def __len__(self):
+        return self.syn0.shape[0]
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def __getitem__(self, word):
+        return self.syn0[self.index[word]]
+
+
+def convert(w2v_path, out_dir):
+    ''' Write the vectors in the word2vec binary at w2v_path to out_dir. '''
+    import gensim
+    m = gensim.models.KeyedVectors.load_word2vec_format(w2v_path, binary=True)
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    np.save(os.path.join(out_dir, "vectors.npy"), np.asarray(m.syn0, dtype=np.float32))
+    with open(os.path.join(out_dir, "words.json"), "w") as words_f:
+        json.dump(list(m.index2word), words_f)
+
+    meta = {"source": os.path.abspath(w2v_path), "n_words": m.syn0.shape[0],
+            "dimensions": m.syn0.shape[1]}
+    # (written last: a directory without it is incomplete)
+    with open(os.path.join(out_dir, META_FILE), "w") as meta_f:
+        json.dump(meta, meta_f, indent=1, sort_keys=True)
+    print("converted {0} vectors ({1} dimensions) to {2}".format(
+                meta["n_words"], meta["dimensions"], out_dir))
+
+
+def is_converted(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+
+def load_vectors(vectors_dir, words=None, mmap_mode="r"):
+    '''
+    WordVectors from vectors_dir (see convert). If words is given, only
+    the vectors of those of them that have one are read (into memory);
+    otherwise syn0 is the full, memory mapped, matrix.
+    '''
+    if not is_converted(vectors_dir):
+        raise ValueError("{0} does not hold converted word vectors".format(vectors_dir))
+
+    with open(os.path.join(vectors_dir, "words.json")) as words_f:
+        all_words = json.load(words_f)
+    vectors = np.load(os.path.join(vectors_dir, "vectors.npy"), mmap_mode=mmap_mode)
+    if words is None:
+        return WordVectors(all_words, vectors)
+
+    words = set(words)
+    found = [(row, word) for row, word in enumerate(all_words) if word in words]
+    rows = np.array([row for row, _ in found], dtype=np.int64)
+    syn0 = np.array(vectors[rows]) if rows.shape[0] > 0 else np.zeros((0, vectors.shape[1]),
+                                                                        dtype=vectors.dtype)
+    print("read vectors for {0} of {1} words from {2}".format(len(found), len(words), vectors_dir))
+    return WordVectors([word for _, word in found], syn0)
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+
+    parser.add_option('-i', '--input', dest="w2v_path",
+        help="word2vec (binary) vectors", default="PubMed-w2v.bin")
+
+    parser.add_option('-o', '--out-dir', dest="out_dir",
+        help="where to write the converted vectors", default="data/PubMed-w2v")
+
+    (options, args) = parser.parse_args()
+    convert(options.w2v_path, options.out_dir)
@@ -0,0 +1,197 @@
+'''
+Near-duplicate detection over full texts, with MinHash and locality
+sensitive hashing (LSH).
+
+The same trial often appears in the RoB data under different uids (and
+pmid/doi values), e.g. when included in several reviews. Exact uid
+matching misses these, which leaks studies across the train/dev/test
+splits. Comparing every pair of full texts is quadratic; instead we
+
+ 1. represent each text by its set of word k-shingles,
+ 2. summarize each set by a MinHash signature, whose agreement
+    estimates the Jaccard similarity of two sets, and
+ 3. split signatures into bands and bucket texts by band, so that only
+    texts sharing a bucket (for some band) are ever compared.
+
+With b bands of r rows, pairs with similarity s become candidates with
+probability 1 - (1 - s^r)^b; the defaults (16 x 8) catch nearly all
+pairs above 0.8 and very few below 0.5. Candidates are then checked
+against the threshold using their full signatures.
+'''
+
+import re
+import zlib
+import collections
+
+import numpy as np
+
+# large (Mersenne) prime for the universal hashes a*x + b mod p
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def shingle_hashes(text, k=5):
+    '''
+    32-bit hashes of the (lowercased) word k-shingles of text. Token
+    hashes are combined with a polynomial rolling hash, so the work is
+    one crc32 per token. Texts without tokens have no shingles.
+    '''
+    tokens = re.findall(r"\w+", text.lower())
+    if len(tokens) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    token_hashes = np.array([zlib.crc32(token.encode("utf-8")) for token in tokens],
+                            dtype=np.uint64)
+    if len(tokens) < k:
+        k = len(tokens)
+
+    n_shingles = len(tokens) - k + 1
+    shingles = np.zeros(n_shingles, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for offset in range(k):
+            # (unsigned arithmetic wraps around, which is what we want)
+            shingles = shingles * np.uint64(1000003) + token_hashes[offset:offset + n_shingles]
+    return np.unique(shingles & np.uint64(MAX_HASH))
+
+
+class MinHasher:
+
+    def __init__(self, num_perm=128, seed=1337):
+        random_state = np.random.RandomState(seed)
+        # a*x + b stays below 2^64 for a, b < 2^31 and x < 2^32
+        self.a = random_state.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self.b = random_state.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+        self.num_perm = num_perm
+
+    def signature(self, hashes, block_size=10000):
+        '''
+        MinHash signature (num_perm values) of a set of 32-bit hashes;
+        computed a block of hashes at a time, to bound memory for very
+        long texts. The signature of the empty set is all 
+        MERSENNE_PRIME, which no hash maps to (see is_empty).
+        '''
+        signature = np.full(self.num_perm, MERSENNE_PRIME, dtype=np.uint64)
+        for start in range(0, hashes.shape[0], block_size):
+            block = hashes[start:start + block_size, None]
+            permuted = (block * self.a[None, :] + self.b[None, :]) % np.uint64(MERSENNE_PRIME)
+            signature = np.minimum(signature, permuted.min(axis=0))
+        return signature
+
+
+def minhash_signatures(texts, num_perm=128, k=5, seed=1337):
+    ''' (len(texts) x num_perm) matrix of MinHash signatures '''
+    hasher = MinHasher(num_perm=num_perm, seed=seed)
+    signatures = [hasher.signature(shingle_hashes(text, k=k)) for text in texts]
+    if len(signatures) == 0:
+        return np.zeros((0, num_perm), dtype=np.uint64)
+    return np.vstack(signatures)
+
+
+def is_empty(signatures):
+    ''' which of the signatures are of empty sets (texts without tokens) '''
+    return (signatures == MERSENNE_PRIME).all(axis=1)
+
+
+def candidate_pairs(signatures, bands=16):
+    '''
+    Pairs (i, j), i < j, of rows of signatures that agree on all rows of
+    at least one band. Signatures of empty sets are left out: texts 
+    without tokens are not duplicates of anything.
+    '''
+    n_rows = signatures.shape[1] // bands
+    indexed = np.nonzero(~is_empty(signatures))[0]
+    pairs = set()
+    for band in range(bands):
+        band_values = signatures[indexed, band * n_rows:(band + 1) * n_rows]
+        buckets = collections.defaultdict(list)
+        for idx, key in zip(indexed, map(bytes, band_values)):
+            buckets[key].append(int(idx))
+        for members in buckets.values():
+            for i_pos, i in enumerate(members):
+                for j in members[i_pos + 1:]:
+                    pairs.add((i, j))
+    return sorted(pairs)
+
+
+def find_near_duplicates(texts, threshold=0.8, num_perm=128, bands=16, k=5, seed=1337):
+    '''
+    Pairs (i, j, similarity) of texts (by position) whose estimated
+    Jaccard similarity is at least threshold.
+    '''
+    signatures = minhash_signatures(texts, num_perm=num_perm, k=k, seed=seed)
+    return signature_pairs(signatures, threshold=threshold, bands=bands)
+
+
+def signature_pairs(signatures, threshold=0.8, bands=16):
+    '''
+    Pairs (i, j, similarity) of rows of signatures whose estimated
+    Jaccard similarity is at least threshold.
+    '''
+    duplicates = []
+    for i, j in candidate_pairs(signatures, bands=bands):
+        similarity = float(np.mean(signatures[i] == signatures[j]))
+        if similarity >= threshold:
+            duplicates.append((i, j, similarity))
+    return duplicates
+
+
+def group_labels(n, pairs):
+    '''
+    Connected components (as a label per item, 0..n-1) of the graph
+    with the given (i, j, ...) edges; union-find with path halving.
+    '''
+    parent = list(range(n))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for pair in pairs:
+        root_i, root_j = find(pair[0]), find(pair[1])
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    return np.array([find(i) for i in range(n)], dtype=np.int64)
+
+
+def near_duplicate_groups(study_chunks, threshold=0.8, num_perm=128, bands=16, k=5,
+                            seed=1337):
+    '''
+    Groups of uids in study_chunks (DataFrames of rows of the RoB CSV,
+    with at least the uid and fulltext columns; e.g., from
+    read_data.iter_studies) that are the same study: either the same
+    uid, or near-duplicate full texts. Only the signatures are kept
+    across chunks, never the full texts. Returns a dict mapping each uid
+    to a group label (the uid of its group's first member), and the
+    near-duplicate pairs (as rows of the CSV: index i, index j,
+    similarity).
+    '''
+    uids, index, signatures = [], [], []
+    for studies in study_chunks:
+        studies = studies.dropna(subset=["uid", "fulltext"])
+        uids.extend(studies["uid"].tolist())
+        index.extend(studies.index.tolist())
+        signatures.append(minhash_signatures(studies["fulltext"].tolist(),
+                                                num_perm=num_perm, k=k, seed=seed))
+    signatures = np.vstack(signatures) if len(signatures) > 0 else \
+                    np.zeros((0, num_perm), dtype=np.uint64)
+    positions = signature_pairs(signatures, threshold=threshold, bands=bands)
+
+    # link rows sharing a uid, too
+    first_row_for = {}
+    links = [(i, j) for i, j, _ in positions]
+    for row_idx, uid in enumerate(uids):
+        links.append((first_row_for.setdefault(uid, row_idx), row_idx))
+
+    labels = group_labels(len(uids), links)
+    group_of = {uid: uids[labels[row_idx]] for row_idx, uid in enumerate(uids)}
+    pairs = [(index[i], index[j], similarity) for i, j, similarity in positions]
+    return group_of, pairs
+
+
+def redundant_rows(pairs):
+    '''
+    Given near-duplicate pairs (index i, index j, similarity), rows
+    that duplicate an earlier row, i.e. whose full texts need not be
+    parsed again.
+    '''
+    return sorted(set(max(i, j) for i, j, _ in pairs))
@@ -1,35 +1,95 @@
 
 # coding: utf-8
 
+import os
+import json
+import shutil
+import hashlib
+import optparse
+import itertools
+import collections
+import multiprocessing
+
+import numpy as np
 import pandas as pd
 import spacy
-nlp = spacy.load('en')
+# the dependency parser is what sets sentence boundaries (doc.sents); the
+# tagger and entity recognizer play no part in that, so we skip them.
+UNUSED_PIPES = ["tagger", "ner"]
 import fuzzywuzzy
 from fuzzywuzzy import fuzz
 
+import RoB_dedup
+import RoB_matching
+import RoB_profiling
+import RoB_sentence_cache
+import RoB_splits
+import read_data
+
 data_path = "data/RoB-data-w-uids.csv"
-tp = pd.read_csv(data_path, chunksize=10000)
-df = pd.concat(tp, ignore_index=True)
-df = df.dropna(subset=["fulltext"]) # drop rows where we don't have full texts
-#df = df.drop(['Unnamed: 0'], axis=1)
+
+_nlp = None
+def get_nlp():
+    '''
+    The spaCy pipeline; loaded on first use, so that importing this
+    module does not touch the disk.
+    '''
+    global _nlp
+    if _nlp is None:
+        _nlp = spacy.load('en', disable=UNUSED_PIPES)
+    return _nlp
+
+
+# full texts are truncated to MAX_FT_LEN characters by default.
+MAX_FT_LEN = 15000 # covers 99%+ of cases; there is one outlier with 2902523, which breaks things...
+# alternatively (max_ft_len=None), long texts can be segmented in windows
+# of WINDOW_SIZE characters, overlapping by WINDOW_OVERLAP.
+WINDOW_SIZE = 100000
+WINDOW_OVERLAP = 2000
 
 def get_col_names(domain_str):
     return (domain_str + "-judgment", domain_str + "-rationale")  
 
 def get_quote(rationale_str):
-    Q = "Quote:"
-    if Q in rationale_str:
-        # annoying but sometimes there are different quote chars used (?!)
-        # so we normalize here. hacky.
-        rationale_str = rationale_str.replace('“', '"').replace('”', '"')
-        if not '"' in rationale_str:
-            print("no rationale string! {0}".format(rationale_str))
-            return None 
-        try:
-            return rationale_str[rationale_str.index(Q):].split('"')[1]
-        except:
-            import pdb; pdb.set_trace()
-    return None 
+    quotes, errors = extract_quotes(pd.Series([rationale_str]))
+    if errors.shape[0] > 0:
+        print("{0}! {1}".format(errors["error"].iloc[0], rationale_str))
+    return quotes.iloc[0]
+
+
+# the quoted text following the first "Quote:" (up to the next quote
+# mark, or the end of the string if there is none)
+QUOTE_PATTERN = r'Quote:[^"]*"([^"]*)'
+
+def extract_quotes(rationales):
+    '''
+    Vectorized get_quote over a Series of rationale strings (NaN where
+    missing). Returns the quotes (a Series, None where there are none)
+    and a DataFrame of the rationales that have a "Quote:" marker but
+    no quote that could be parsed (index, error, rationale).
+    '''
+    values = rationales.to_numpy(dtype=object)
+    quotes = np.full(values.shape[0], None, dtype=object)
+    present_pos = np.nonzero(rationales.notnull().to_numpy())[0]
+    present = pd.Series(values[present_pos], dtype=object).astype(str)
+    marked_pos = present_pos[present.str.contains("Quote:", regex=False).to_numpy(dtype=bool)]
+    marked = pd.Series(values[marked_pos], dtype=object).astype(str)
+
+    # annoying but sometimes there are different quote chars used (?!)
+    # so we normalize here. hacky.
+    marked = marked.str.replace('“', '"', regex=False).str.replace('”', '"', regex=False)
+    extracted = marked.str.extract(QUOTE_PATTERN, expand=False)
+    found = extracted.notnull().to_numpy(dtype=bool)
+    quotes[marked_pos[found]] = extracted[found].tolist()
+
+    failed_pos = marked_pos[~found]
+    no_marks = ~marked[~found].str.contains('"', regex=False).to_numpy(dtype=bool)
+    errors = pd.DataFrame({"index": list(rationales.index[failed_pos]),
+                           "error": np.where(no_marks, "no quote marks", "no quote after marker"),
+                           "rationale": values[failed_pos]},
+                          columns=["index", "error", "rationale"])
+    quotes = pd.Series(quotes, index=rationales.index, dtype=object)
+    return quotes, errors
 
 def is_sent_match(rationale, candidate, threshold=90, min_k=5):
     # assume rationales need to be at least k words.
@@ -63,187 +123,1048 @@ def is_sent_match(rationale, candidate, threshold=90, min_k=5):
 '''
 
 
+def model_id():
+    ''' identifies the parser (and so the sentence boundaries it produces) '''
+    nlp = get_nlp()
+    return "{0}-{1}/spacy-{2}".format(nlp.meta["name"], nlp.meta["version"], 
+                                        spacy.__version__)
+
+
+def open_sentence_cache(path, max_entries=None, max_bytes=None):
+    return RoB_sentence_cache.SentenceCache(path, model_id(), 
+                                    max_entries=max_entries, max_bytes=max_bytes)
+
+
+def _sentence_offsets(document, start=0):
+    # sent.string includes trailing whitespace, hence the end offset
+    return [(start + sent.start_char, start + sent.start_char + len(sent.string))
+                for sent in document.sents]
+
+
+def windowed_sentence_offsets(text, window_size=WINDOW_SIZE, overlap=WINDOW_OVERLAP):
+    '''
+    Sentence (start, end) offsets for a text of any length, parsed in
+    windows of window_size characters so that the parser never sees
+    (or needs memory for) more than that at once.
+
+    Sentences ending within overlap characters of a window's edge may
+    have been cut short, so we keep only those that end earlier and
+    start the next window where the last kept sentence ended.
+    '''
+    assert overlap < window_size
+    nlp = get_nlp()
+    offsets, start = [], 0
+    while start < len(text):
+        end = min(start + window_size, len(text))
+        spans = _sentence_offsets(nlp(text[start:end]), start=start)
+        if end == len(text):
+            offsets.extend(spans)
+            break 
+
+        if len(spans) == 0:
+            start = end
+            continue 
+
+        safe_spans = [span for span in spans if span[1] <= end - overlap]
+        if len(safe_spans) == 0:
+            # a single sentence spanning (nearly) the whole window;
+            # take it as is, so that we always make progress
+            safe_spans = spans[:1]
+        offsets.extend(safe_spans)
+        start = safe_spans[-1][1]
+    return offsets
+
+
+def segment_sentences(texts, n_process=1, batch_size=50, cache=None, block_size=1000,
+                        window_size=None, window_overlap=WINDOW_OVERLAP):
+    '''
+    Stream texts through spaCy, yielding the list of sentence strings
+    for each text (in order). With n_process > 1 parsing is spread
+    across that many worker processes.
+
+    If a SentenceCache is given, texts are handled in blocks of
+    block_size: boundaries are looked up in the cache and only texts
+    not found there are parsed (and then added to the cache). If
+    window_size is given, texts longer than that are segmented in
+    overlapping windows (see windowed_sentence_offsets).
+    '''
+    nlp = get_nlp()
+    if cache is None and window_size is None:
+        for document in nlp.pipe(texts, batch_size=batch_size, n_process=n_process):
+            yield [sent.string for sent in document.sents]
+        return 
+
+    def is_long(text):
+        return window_size is not None and len(text) > window_size
+
+    # windowed boundaries can differ from those of a single parse
+    window_variant = "window-{0}-{1}".format(window_size, window_overlap)
+
+    texts = iter(texts)
+    while True:
+        block = list(itertools.islice(texts, block_size))
+        if len(block) == 0:
+            break 
+
+        if cache is not None:
+            keys = [cache.key(text, variant=window_variant if is_long(text) else "") 
+                        for text in block]
+            offsets = cache.get_many(keys)
+        else:
+            keys, offsets = list(range(len(block))), {}
+
+        # parse each text that is missing from the cache (once)
+        to_parse = {}
+        for text, key in zip(block, keys):
+            if key not in offsets and key not in to_parse:
+                to_parse[key] = text
+
+        short_keys = [key for key in to_parse if not is_long(to_parse[key])]
+        parsed = nlp.pipe((to_parse[key] for key in short_keys), 
+                            batch_size=batch_size, n_process=n_process)
+        for key, document in zip(short_keys, parsed):
+            offsets[key] = _sentence_offsets(document)
+
+        for key in to_parse:
+            if is_long(to_parse[key]):
+                offsets[key] = windowed_sentence_offsets(to_parse[key], 
+                                        window_size=window_size, overlap=window_overlap)
+
+        if cache is not None:
+            cache.put_many((key, offsets[key]) for key in to_parse)
+
+        for text, key in zip(block, keys):
+            yield [text[start:end] for start, end in offsets[key]]
+
+
+JUDGMENT_LEVELS = ["low", "high", "unclear", "unk"]
+
+# column order of the flat (single CSV) layout
+FLAT_COLUMNS = ["pmid", "doi", "doc_id", "sentence",
+                "rsg-rationale", "rsg-doc-judgment",
+                "ac-rationale", "ac-doc-judgment",
+                "bpp-rationale-all", "bpp-doc-judgment-all",
+                "bpp-rationale-mortality", "bpp-doc-judgment-mortality",
+                "bpp-rationale-objective", "bpp-doc-judgment-objective",
+                "bpp-rationale-subjective", "bpp-doc-judgment-subjective",
+                "boa-rationale-all", "boa-doc-judgment-all",
+                "boa-rationale-mortality", "boa-doc-judgment-mortality",
+                "boa-rationale-objective", "boa-doc-judgment-objective",
+                "boa-rationale-subjective", "boa-doc-judgment-subjective"]
+
+domain_name_map = {"bpp":"Blinding of participants and personnel",
+                   "rsg":"Random sequence generation",
+                   "ac":"Allocation concealment",
+                   "boa":"Blinding of outcome assessment"}
+
+outcome_categories = ["mortality", "objective", "subjective", "all"]
+
+RATIONALE_FIELDS = [col for col in FLAT_COLUMNS if "-rationale" in col]
+
+# a sentence is labeled a rationale if it matches the quote at
+# MATCH_THRESHOLD and has at least MIN_K words (see is_sent_match).
+MATCH_THRESHOLD = 90
+MIN_K = 5
+# raw similarity scores at or above SCORE_FLOOR are stored as well, so
+# that labels for other thresholds can be derived without re-formatting
+# (see read_data.label_rationales).
+SCORE_FLOOR = 70
+# bump when the layout of the formatted tables changes (e.g., the exact
+# column of the scores table), so that outputs of older runs are not
+# extended or merged with new ones
+FORMAT_VERSION = 2
+
+# documents table columns holding the character offsets of each quote
+# in the full text (-1 where it was not found verbatim)
+def get_quote_offset_cols(rationale_field_key):
+    return (rationale_field_key.replace("-rationale", "-quote-start"),
+            rationale_field_key.replace("-rationale", "-quote-end"))
+
+
+def _empty_tables():
+    # here we construct dictionaries to be converted to DataFrames for
+    # output: one row per study (document-level fields), one row per
+    # sentence (rationale labels), joined on doc_idx, and one row per
+    # (sentence, rationale field) pair scoring at least the score floor.
+    # note that RSG and AC are only overall.
+    docs = {"doc_idx":[], "pmid":[], "doi":[], "doc_id": [], "content_hash":[],
+            "rsg-doc-judgment":[], "ac-doc-judgment":[],
+            "bpp-doc-judgment-all":[], "bpp-doc-judgment-mortality":[],
+            "bpp-doc-judgment-objective":[], "bpp-doc-judgment-subjective":[],
+            "boa-doc-judgment-all":[], "boa-doc-judgment-mortality":[],
+            "boa-doc-judgment-objective":[], "boa-doc-judgment-subjective":[]}
+    for rationale_field_key in RATIONALE_FIELDS:
+        for offset_col in get_quote_offset_cols(rationale_field_key):
+            docs[offset_col] = []
+
+    sents = {"doc_idx":[], "sent_idx":[], "sentence":[], "n_words":[],
+             "rsg-rationale":[], "ac-rationale":[],
+             "bpp-rationale-all":[], "bpp-rationale-mortality":[],
+             "bpp-rationale-objective":[], "bpp-rationale-subjective":[],
+             "boa-rationale-all":[], "boa-rationale-mortality":[],
+             "boa-rationale-objective":[], "boa-rationale-subjective":[]}
+
+    scores = {"doc_idx":[], "sent_idx":[], "field":[], "score":[], "exact":[]}
+    return docs, sents, scores
+
+
+def get_domains_and_keys():
+    '''
+    (domain, judgment key, rationale key) triples; the columns of the
+    RoB CSV for each follow from get_col_names(domain).
+    '''
+    all_domains_and_keys = []
+    for abbrv, domain in list(domain_name_map.items()):
+        if abbrv in ["rsg", "ac"]:
+            # simple case; only overall judgment
+            domains_and_keys = [(domain, abbrv + "-doc-judgment", abbrv + "-rationale")]
+        else:
+            # more complicated, need to loop over outcome
+            # categories/types
+            domains_and_keys = [(domain + "-" + outcome_type,
+                                    abbrv + "-doc-judgment-" + outcome_type,
+                                    abbrv + "-rationale-" + outcome_type)
+                                        for outcome_type in outcome_categories]
+        all_domains_and_keys.extend(domains_and_keys)
+    return all_domains_and_keys
+
+
+def extract_study_quotes(studies):
+    '''
+    Parse the quotes out of all the rationale columns of studies (a
+    chunk of the RoB CSV) at once. Returns a DataFrame of quotes (one
+    column per rationale column; None where there is no quote) and a
+    DataFrame of errors (doc_idx, column, error, rationale) for those
+    that could not be parsed.
+    '''
+    rationale_cols = [get_col_names(domain_str)[1] 
+                        for domain_str, _, _ in get_domains_and_keys()]
+    # stack the columns into one long Series, so that the string
+    # operations run once over all of them
+    stacked = pd.concat([studies[col].astype(object) for col in rationale_cols],
+                        keys=rationale_cols)
+    quotes, errors = extract_quotes(stacked)
+
+    # (stacked column by column)
+    quotes = quotes.to_numpy(dtype=object).reshape(len(rationale_cols), studies.shape[0])
+    quotes = pd.DataFrame(quotes.T, index=studies.index, columns=rationale_cols, dtype=object)
+    errors = pd.DataFrame({"doc_idx": [idx[1] for idx in errors["index"]],
+                           "column": [idx[0] for idx in errors["index"]],
+                           "error": errors["error"], "rationale": errors["rationale"]},
+                          columns=["doc_idx", "column", "error", "rationale"])
+    return quotes, errors
+
+
+def get_label_fields(row, row_quotes=None):
+    '''
+    Extract each domain's judgment and quoted rationale from a study
+    (row). Returns label_fields, a list of (judgment key, judgment,
+    rationale key) triples, and the quotes (None where there are
+    none) in the same order.
+
+    row_quotes maps rationale columns to their quotes, as extracted
+    by extract_study_quotes; if not given, they are extracted here.
+    '''
+    if row_quotes is None:
+        row_quotes = extract_study_quotes(row.to_frame().T)[0].iloc[0]
+
+    label_fields, quotes = [], []
+    for domain_str, domain_field_key, rationale_field_key in get_domains_and_keys():
+        judgment_col, rationale_col = get_col_names(domain_str)
+        label_fields.append((domain_field_key, row[judgment_col], rationale_field_key))
+        quotes.append(row_quotes[rationale_col])
+
+    return label_fields, quotes
+
+
+def format_study(index, row, sentences, docs, sents, scores, score_floor=SCORE_FLOOR,
+                    exact_first=False, profiler=None, row_quotes=None):
+    '''
+    Label the sentences of a single study and append the results to
+    the docs, sents and scores tables (dicts of lists). row_quotes are
+    the study's quotes, if already extracted (see get_label_fields).
+
+    Quotes are first located verbatim in the full text, which gives
+    their offsets. If exact_first is True, the sentences spanned by a
+    quote found this way are taken to be its rationales (with a score
+    of 100, flagged as exact in the scores table) and only the quotes 
+    not found are matched fuzzily; this is much faster, but labels 
+    differ from those of is_sent_match where quotes span several 
+    sentences or only part of one.
+    '''
+    if profiler is None:
+        profiler = RoB_profiling.StageProfiler()
+
+    cur_pmid = row["pmid"]
+    if pd.isnull(cur_pmid):
+        cur_pmid = 0
+
+    cur_doi = row["doi"]
+    if pd.isnull(cur_doi):
+        cur_doi = "missing"
+
+    with profiler.stage("get_quote"):
+        label_fields, quotes = get_label_fields(row, row_quotes=row_quotes)
+
+    with profiler.stage("align"):
+        # the sentences are consecutive pieces of the (truncated) full text
+        sent_lens = np.array([len(s) for s in sentences], dtype=np.int64)
+        sent_starts = np.concatenate([[0], np.cumsum(sent_lens)[:-1]])
+        spans = RoB_matching.find_quotes(quotes, "".join(sentences))
+
+    # (quotes x sentences) similarity scores, 0 below score_floor, for
+    # the whole study up front. each distinct (quote, sentence) pair is
+    # scored once, however many domains/outcome types share the quote.
+    # thresholding these gives the same labels as calling is_sent_match
+    # on each pair.
+    assert score_floor <= MATCH_THRESHOLD
+    with profiler.stage("match"):
+        fuzzy_quotes = quotes
+        if exact_first:
+            fuzzy_quotes = [q if span is None else None for q, span in zip(quotes, spans)]
+        pair_scores = RoB_matching.score_rationales(fuzzy_quotes, sentences, 
+                                                        min_score=score_floor)
+        exact = np.zeros(pair_scores.shape, dtype=bool)
+        if exact_first:
+            for q_idx, span in enumerate(spans):
+                if span is not None and len(sentences) > 0:
+                    first, last = RoB_matching.sentence_range(span, sent_starts)
+                    pair_scores[q_idx, first:last+1] = 100
+                    exact[q_idx, first:last+1] = True
+        n_words = np.array([len(s.split(" ")) for s in sentences], dtype=np.int32)
+        matches = (pair_scores >= MATCH_THRESHOLD) & (n_words >= MIN_K)[None, :]
+
+    with profiler.stage("tables"):
+        docs["doc_idx"].append(index)
+        docs["doc_id"].append(row["uid"])
+        docs["content_hash"].append(get_content_hash(row))
+        docs["doi"].append(cur_doi)
+        docs["pmid"].append(cur_pmid)
+        for (domain_field_key, domain_judgment, rationale_field_key), span in zip(label_fields, 
+                                                                                    spans):
+            docs[domain_field_key].append(domain_judgment)
+            start_col, end_col = get_quote_offset_cols(rationale_field_key)
+            docs[start_col].append(-1 if span is None else span[0])
+            docs[end_col].append(-1 if span is None else span[1])
+
+        sents["doc_idx"].extend([index] * len(sentences))
+        sents["sent_idx"].extend(range(len(sentences)))
+        sents["sentence"].extend(sentences)
+        sents["n_words"].extend(n_words.tolist())
+        for field_idx, (_, _, rationale_field_key) in enumerate(label_fields):
+            sents[rationale_field_key].extend(matches[field_idx].astype(int).tolist())
+
+        # sparse: only the (few) pairs that reach the floor
+        field_idxs, sent_idxs = np.nonzero(pair_scores >= score_floor)
+        scores["doc_idx"].extend([index] * len(sent_idxs))
+        scores["sent_idx"].extend(sent_idxs.tolist())
+        scores["field"].extend(label_fields[f_idx][2] for f_idx in field_idxs)
+        scores["score"].extend(pair_scores[field_idxs, sent_idxs].tolist())
+        scores["exact"].extend(exact[field_idxs, sent_idxs].tolist())
+    profiler.count(documents=1, sentences=len(sentences))
+
+
+def _iter_rows(study_chunks, quote_errors=None, profiler=None):
+    for studies in study_chunks:
+        # quotes are parsed for a whole chunk at a time
+        with profiler.stage("get_quote"):
+            quotes, errors = extract_study_quotes(studies)
+        if quote_errors is not None and errors.shape[0] > 0:
+            quote_errors.append(errors)
+        for (index, row), row_quotes in zip(studies.iterrows(), 
+                                            quotes.to_dict("records")):
+            yield index, row, row_quotes
+
+
 '''
 Consume RoB data in the CSV; convert to RA-CNN style data.
 '''
-MAX_FT_LEN = 15000 # covers 99%+ of cases; there is one outlier with 2902523, which breaks things...
-def convert_df_to_training_data(path="RoB_data.csv", study_range=None):
-    
+def iter_formatted(study_chunks, n_process=1, batch_size=50, flush_every=1000,
+                        sentence_cache=None, max_ft_len=MAX_FT_LEN, window_size=None,
+                        score_floor=SCORE_FLOOR, exact_first=False, profiler=None,
+                        quote_errors=None):
+    '''
+    Format a stream of studies (an iterable of DataFrame chunks, e.g.
+    from read_data.iter_studies), yielding (documents, sentences, scores)
+    DataFrame triples covering flush_every studies at a time (or all of
+    them at once, if flush_every is None). scores holds the raw
+    similarity of every (sentence, rationale field) pair scoring at
+    least score_floor. (See format_study regarding exact_first.)
 
-    domain_name_map = {"bpp":"Blinding of participants and personnel", 
-                       "rsg":"Random sequence generation",
-                       "ac":"Allocation concealment",
-                       "boa":"Blinding of outcome assessment"}
-                       
-    
-    # here we construct a dictionary to be converted to a DataFrame
-    # for output.
-    # note that RSG and AC are only overall.
-    d = {"pmid":[], "doi":[], "doc_id": [], "sentence":[], 
-         "rsg-rationale":[], "rsg-doc-judgment":[],
-         "ac-rationale":[], "ac-doc-judgment":[], 
-         "bpp-rationale-all":[], "bpp-doc-judgment-all":[],
-         "bpp-rationale-mortality":[], "bpp-doc-judgment-mortality":[],
-         "bpp-rationale-objective":[], "bpp-doc-judgment-objective":[],
-         "bpp-rationale-subjective":[], "bpp-doc-judgment-subjective":[],
-         "boa-rationale-all":[], "boa-doc-judgment-all":[],
-         "boa-rationale-mortality":[], "boa-doc-judgment-mortality":[],
-         "boa-rationale-objective":[], "boa-doc-judgment-objective":[],
-         "boa-rationale-subjective":[], "boa-doc-judgment-subjective":[]}
-         
-    outcome_categories = ["mortality", "objective", "subjective", "all"]
-    
-    rows_to_process = list(df.iterrows())
-    for index, row in rows_to_process:
+    Studies are pulled through segmentation and labeling a batch at a
+    time, so memory use is bounded by the chunk and flush sizes rather
+    than by the size of the corpus. sentence_cache (a SentenceCache)
+    saves re-parsing texts that were segmented in earlier runs.
+
+    Full texts are truncated to max_ft_len characters, unless this is
+    None; texts longer than window_size (if given) are segmented in
+    overlapping windows.
+
+    Time spent in each stage is recorded by profiler (a
+    RoB_profiling.StageProfiler), if given. Rationales whose quotes
+    cannot be parsed are reported (as DataFrames; see
+    extract_study_quotes) by appending to the list quote_errors, if
+    given.
+    '''
+    if profiler is None:
+        profiler = RoB_profiling.StageProfiler()
+    study_chunks = profiler.iter_stage("read", study_chunks)
+
+    # sentence segmentation is by far the most expensive step, so
+    # we stream all full texts through the parser in batches
+    rows_for_texts, rows = itertools.tee(_iter_rows(study_chunks, quote_errors=quote_errors,
+                                                    profiler=profiler))
+    full_texts = (row["fulltext"][:max_ft_len] for _, row, _ in rows_for_texts)
+    sentence_lists = segment_sentences(full_texts, n_process=n_process,
+                                        batch_size=batch_size, cache=sentence_cache,
+                                        window_size=window_size)
+    sentence_lists = profiler.iter_stage("segment", sentence_lists)
+
+    docs, sents, scores = _empty_tables()
+    n_pending, n_flushed = 0, 0
+    for (index, row, row_quotes), sentences in zip(rows, sentence_lists):
         if (index % 50) == 0:
             print ("on study {0}".format(index))
-            
-        full_text = row["fulltext"][:MAX_FT_LEN]
- 
-        document = nlp(full_text)
-        sentences = list(document.sents)
-        is_rationale = []
-        for sent in sentences:
-            sent = sent.string
-            cur_pmid = row["pmid"]
-            if pd.isnull(cur_pmid):
-                cur_pmid = 0
-
-            cur_doi = row["doi"]
-            if pd.isnull(cur_doi):
-                cur_doi = "missing"
-
-            '''
-            if cur_pmid == 0 and cur_doi == "missing":
-                import pdb; pdb.set_trace()
-            elif cur_pmid != 0:
-                doc_id = str(int(cur_pmid))
-            else:
-                doc_id = cur_doi 
-            '''
-
-            d["doc_id"].append(row["uid"])
-            d["doi"].append(cur_doi)
-            d["pmid"].append(cur_pmid) 
-            d["sentence"].append(sent)
-            #d["doc_id"].append(doc_id)
-
-            for abbrv, domain in list(domain_name_map.items()):
-                domain_rationale, rationale_field_key = None, None
-                if abbrv in ["rsg", "ac"]:
-                    # simple case; only overall judgment
-                    judgment_col, rationale_col = get_col_names(domain)
-                    if not pd.isnull(row[rationale_col]):
-                        domain_rationale = get_quote(row[rationale_col])
-                    domain_judgment = row[judgment_col]
-                    
-                    domain_field_key = abbrv + "-doc-judgment"
-                    d[domain_field_key].append(domain_judgment)
-                    
-                    rationale_field_key = abbrv + "-rationale"
-                    if not (domain_rationale is None) and is_sent_match(domain_rationale, sent):
-                        d[rationale_field_key].append(1)
-                    else:
-                        d[rationale_field_key].append(0)
-                                
-                else:
-                    # more complicated, need to loop over outcome
-                    # categories/types
-                    for outcome_type in outcome_categories:
-                        domain_rationale, rationale_field_key = None, None
-                        domain_plus_outcome = domain + "-" + outcome_type
-                        judgment_col, rationale_col = get_col_names(domain_plus_outcome)
-                        #if "Patients were assessed" in sent:
-                        #    import pdb; pdb.set_trace()
-                        if not pd.isnull(row[rationale_col]):
-                            domain_rationale = get_quote(row[rationale_col])
-                        domain_judgment = row[judgment_col]
-
-                        domain_field_key = abbrv + "-doc-judgment-" + outcome_type
-                        d[domain_field_key].append(domain_judgment)
-                    
-                        rationale_field_key = abbrv + "-rationale-" + outcome_type
-                        if not (domain_rationale is None) and is_sent_match(domain_rationale, sent):
-                            d[rationale_field_key].append(1)
-                        else:
-                            d[rationale_field_key].append(0)
-                            
-    
-    return pd.DataFrame(d)
 
+        format_study(index, row, sentences, docs, sents, scores, score_floor=score_floor,
+                        exact_first=exact_first, profiler=profiler, row_quotes=row_quotes)
+        n_pending += 1
 
+        if flush_every is not None and n_pending == flush_every:
+            with profiler.stage("dataframe"):
+                tables = pd.DataFrame(docs), pd.DataFrame(sents), pd.DataFrame(scores)
+            yield tables
+            docs, sents, scores = _empty_tables()
+            n_pending = 0
+            n_flushed += 1
 
-def put_together(outpath="data/RoB-data-2-all.csv"):
-    increment_by = 500
-    cur_start, cur_end = 0, 500
-    N = 28428
+    if n_pending > 0 or n_flushed == 0:
+        with profiler.stage("dataframe"):
+            tables = pd.DataFrame(docs), pd.DataFrame(sents), pd.DataFrame(scores)
+        yield tables
 
-    df = None
-    while cur_start < N: 
-        # print ("cur_start: {0}; cur_end: {1}")
-        cur_df = pd.read_csv("data/RoB-data-2-{0}--{1}.csv".format(cur_start, cur_end))
 
-        if df is None:
-            df = cur_df
-        else:
-            df = pd.concat([df, cur_df])
-        
-        cur_start += increment_by
-        cur_end += increment_by
+def convert_df_to_training_data(path="RoB_data.csv", study_range=None,
+                                    n_process=1, batch_size=50, normalized=False,
+                                    studies=None, sentence_cache=None, 
+                                    max_ft_len=MAX_FT_LEN, window_size=None,
+                                    score_floor=SCORE_FLOOR, exact_first=False, 
+                                    profiler=None, quote_errors=None):
+    '''
+    Formats studies (a DataFrame of rows from the RoB CSV; defaults to
+    all of them), optionally restricted to study_range. Returns a single
+    flat DataFrame (one row per sentence, document-level fields repeated)
+    or, if normalized is True, a (documents, sentences, scores) triple of
+    DataFrames joined on doc_idx.
 
-    df.to_csv(outpath)
+    Everything here is held in memory; format_streaming is the
+    bounded-memory equivalent.
+    '''
+    if studies is None:
+        studies = read_data.load_studies(data_path)
+    if study_range is not None:
+        studies = studies.iloc[study_range[0]:study_range[1]]
 
-def main():
-    formatted_data = convert_df_to_training_data()
-    formatted_data.to_csv("RoB-data-4.csv")
-    
+    documents, sentences, scores = next(iter_formatted([studies], n_process=n_process,
+                                                batch_size=batch_size, flush_every=None,
+                                                sentence_cache=sentence_cache,
+                                                max_ft_len=max_ft_len, 
+                                                window_size=window_size,
+                                                score_floor=score_floor,
+                                                exact_first=exact_first,
+                                                profiler=profiler,
+                                                quote_errors=quote_errors))
+    if normalized:
+        return documents, sentences, scores
 
-    # create a doc_id category: this is PMID where available, else DOI
-    # if both unavailable (???) drop
-    # ASSUMPTION: no PMID -> not in PMID
-    formatted_data.to_csv("RoB-data-4.csv")
+    # flat layout: document-level fields repeated on every sentence row
+    return read_data.denormalize(documents, sentences)[FLAT_COLUMNS]
 
+
+def _typed(documents, sentences, scores):
+    '''
+    Column types for the normalized (Parquet) tables: judgments and
+    score fields as categoricals, labels and scores as small ints.
     '''
-    increment_by = 500
-    cur_start, cur_end = 0, 500
-    N = 28432
+    documents, sentences, scores = documents.copy(), sentences.copy(), scores.copy()
+    # pmid is 0 where missing, which would otherwise make it an int column
+    # for some subsets of the data and a float column for others; likewise
+    # uids may be parsed as numbers in some chunks of the CSV only.
+    documents["pmid"] = documents["pmid"].astype("float64")
+    documents["doc_id"] = documents["doc_id"].astype(str)
+    for col in documents.columns:
+        if "-doc-judgment" in col:
+            # fix the categories so that every subset of the data gets
+            # the same (string) column type, even if all values are missing
+            observed = set(documents[col].dropna())
+            levels = JUDGMENT_LEVELS + sorted(observed - set(JUDGMENT_LEVELS))
+            documents[col] = pd.Categorical(documents[col], categories=levels)
+        elif "-quote-" in col:
+            documents[col] = documents[col].astype("int32")
+    for col in sentences.columns:
+        if "-rationale" in col:
+            sentences[col] = sentences[col].astype("int8")
+    for col in ["sent_idx", "n_words"]:
+        sentences[col] = sentences[col].astype("int32")
+
+    scores["doc_idx"] = scores["doc_idx"].astype("int64")
+    scores["sent_idx"] = scores["sent_idx"].astype("int32")
+    scores["field"] = pd.Categorical(scores["field"], categories=RATIONALE_FIELDS)
+    scores["score"] = scores["score"].astype("int8")
+    scores["exact"] = scores["exact"].astype(bool)
+    return documents, sentences, scores
 
-    while cur_start < N: 
-        # print ("cur_start: {0}; cur_end: {1}")
-        formatted_data = convert_df_to_training_data(study_range=[cur_start, cur_end])
-        formatted_data.to_csv("data/RoB-data-2-{0}--{1}.csv".format(cur_start, cur_end))
-        cur_start += increment_by
-        cur_end += increment_by
+
+def write_stream(formatted, out_path, compression="zstd", score_floor=SCORE_FLOOR,
+                    profiler=None):
     '''
+    Write a stream of (documents, sentences, scores) triples to out_path,
+    appending one triple at a time: to a flat CSV if out_path ends in
+    .csv, else to a normalized Parquet directory. Output goes to a
+    temporary path first and is moved into place once complete.
 
+    Only the normalized layout keeps the raw scores (and records the
+    score_floor they were computed with).
+    '''
+    if profiler is None:
+        profiler = RoB_profiling.StageProfiler()
+    tmp_path = out_path + ".tmp"
+    if out_path.endswith(".csv"):
+        offset, header_written = 0, False
+        with open(tmp_path, "w") as outf:
+            for documents, sentences, _ in formatted:
+                with profiler.stage("write"):
+                    formatted_data = read_data.denormalize(documents, sentences)[FLAT_COLUMNS]
+                    # continue the row index, as for a single (unchunked) run
+                    formatted_data.index = pd.RangeIndex(offset, 
+                                                offset + formatted_data.shape[0])
+                    # (once: a first chunk may have no sentences, leaving offset at 0)
+                    formatted_data.to_csv(outf, header=not header_written)
+                    header_written = True
+                    offset += formatted_data.shape[0]
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
 
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        table_files = [read_data.DOCUMENTS_FILE, read_data.SENTENCES_FILE,
+                        read_data.SCORES_FILE]
+        writers, first_tables = [None, None, None], [None, None, None]
+        for tables in formatted:
+            with profiler.stage("write"):
+                for t_idx, table in enumerate(_typed(*tables)):
+                    table = pa.Table.from_pandas(table, preserve_index=False)
+                    if table_files[t_idx] == read_data.SCORES_FILE:
+                        # scores below the floor were not kept
+                        table = table.replace_schema_metadata(dict(table.schema.metadata or {},
+                                                    score_floor=str(score_floor)))
+                    if first_tables[t_idx] is None:
+                        first_tables[t_idx] = table
+                    if table.num_rows == 0:
+                        # column types cannot be inferred from empty tables
+                        continue
+                    if writers[t_idx] is None:
+                        writers[t_idx] = pq.ParquetWriter(
+                                            os.path.join(tmp_path, table_files[t_idx]),
+                                            table.schema, compression=compression)
+                    writers[t_idx].write_table(table)
 
-def train_dev_test_split(RA_CNN_data_path="data/RoB-data-3-all.csv"):
-    ####
-    #  First pull out duplicates. Priority is to identify based on PMIDs, then default to DOI. 
-    ####
-    # df is the original data file that we formatted! 
-    all_data = pd.read_csv(RA_CNN_data_path) 
+        for t_idx, writer in enumerate(writers):
+            if writer is not None:
+                writer.close()
+            elif first_tables[t_idx] is not None:
+                pq.write_table(first_tables[t_idx], os.path.join(tmp_path, table_files[t_idx]),
+                                compression=compression)
 
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+    os.replace(tmp_path, out_path)
 
 
-def get_duplicate_ids():
+def write_normalized(documents, sentences, scores, out_dir, compression="zstd",
+                        score_floor=SCORE_FLOOR, profiler=None):
+    '''
+    Write the documents, sentences and scores tables (as returned by
+    convert_df_to_training_data(normalized=True)) to out_dir as Parquet.
+    '''
+    write_stream([(documents, sentences, scores)], out_dir, compression=compression,
+                    score_floor=score_floor, profiler=profiler)
+
+
+QUOTE_ERRORS_FILE = "quote-errors.csv"
+
+def report_quote_errors(quote_errors, errors_path=None, profiler=None):
+    '''
+    Summarize the rationales whose quotes could not be parsed (a list of
+    DataFrames, see extract_study_quotes), and write them to errors_path
+    (as CSV) if given.
+    '''
+    errors = pd.DataFrame(columns=["doc_idx", "column", "error", "rationale"])
+    if len(quote_errors) > 0:
+        errors = pd.concat(quote_errors, ignore_index=True)
+    if errors.shape[0] > 0:
+        print("could not parse {0} quotes: {1}".format(errors.shape[0],
+                    errors["error"].value_counts().to_dict()))
+    if profiler is not None:
+        profiler.info["quote_errors"] = errors.shape[0]
+    if errors_path is not None:
+        errors.to_csv(errors_path, index=False)
+    return errors
+
+
+def format_streaming(out_path, path=data_path, chunksize=1000,
+                        n_process=1, batch_size=50, cache_path=None, 
+                        cache_max_bytes=None, max_ft_len=MAX_FT_LEN, window_size=None,
+                        score_floor=SCORE_FLOOR, exact_first=False, profile_path=None,
+                        errors_path=None, skip_rows=None):
+    '''
+    Format the RoB CSV at path into out_path (see write_stream), holding
+    no more than chunksize studies in memory at once. If cache_path is
+    given, sentence boundaries are cached there across runs.
+
+    A profile of the run (time per stage, throughput, peak memory) is
+    printed at the end and, if profile_path is given, saved there as JSON.
+    Rationales whose quotes could not be parsed are listed in
+    errors_path, if given (see report_quote_errors).
+
+    skip_rows optionally lists rows (studies) not to format, e.g. near
+    duplicates of other studies (see RoB_dedup.redundant_rows).
+    '''
+    profiler = RoB_profiling.StageProfiler()
+    quote_errors = []
+    sentence_cache = None
+    if cache_path is not None:
+        sentence_cache = open_sentence_cache(cache_path, max_bytes=cache_max_bytes)
+
+    study_chunks = read_data.iter_studies(path, chunksize=chunksize)
+    if skip_rows is not None:
+        skip_rows = set(skip_rows)
+        study_chunks = (studies[~studies.index.isin(skip_rows)] for studies in study_chunks)
+    formatted = iter_formatted(study_chunks, n_process=n_process,
+                                batch_size=batch_size, flush_every=chunksize,
+                                sentence_cache=sentence_cache, max_ft_len=max_ft_len,
+                                window_size=window_size, score_floor=score_floor,
+                                exact_first=exact_first, profiler=profiler,
+                                quote_errors=quote_errors)
+    write_stream(formatted, out_path, score_floor=score_floor, profiler=profiler)
+    report_quote_errors(quote_errors, errors_path, profiler=profiler)
+
+    if sentence_cache is not None:
+        profiler.info["sentence_cache"] = sentence_cache.stats()
+        print("sentence cache: {0}".format(profiler.info["sentence_cache"]))
+        sentence_cache.close()
+    profiler.report(profile_path)
+
+
+def get_content_hash(row):
+    '''
+    Hash of everything we know about a study (a row of the RoB CSV),
+    used to tell which studies changed between versions of the CSV.
+    Column order and int-vs-float parsing of numbers do not matter, and
+    nor do row numbers (`Unnamed: 0', as written by to_csv), which shift
+    whenever studies are added to the CSV.
+    '''
+    h = hashlib.sha1()
+    for col in sorted(row.index):
+        if str(col).startswith("Unnamed:"):
+            continue
+        value = row[col]
+        if pd.isnull(value):
+            value = ""
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        h.update("{0}\0{1}\0".format(col, value).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _uid_key(uid):
+    # uids are strings in the normalized data, but may be read as numbers
+    # (123.0) from the CSV
+    uid = str(uid)
+    if uid.endswith(".0") and uid[:-2].isdigit():
+        uid = uid[:-2]
+    return uid
+
+
+def format_incremental(out_path, path=data_path, chunksize=1000, n_process=1, 
+                        batch_size=50, cache_path=None, max_ft_len=MAX_FT_LEN, 
+                        window_size=None, score_floor=SCORE_FLOOR, exact_first=False, 
+                        profile_path=None, errors_path=None, skip_rows=None):
+    '''
+    Bring the normalized data at out_path up to date with the RoB CSV at
+    path, formatting only the studies that are new or changed (as told
+    by their uid and content hash) since out_path was last formatted; studies no
+    longer in the CSV (or changed) are marked as removed. Unchanged
+    studies are not rewritten: the new ones go into a separate update
+    (see read_data), and get doc_idx values following the existing ones.
+
+    The first run (out_path missing) formats everything. Studies in
+    skip_rows (rows of the CSV at path) are treated as not in the CSV.
+    '''
+    params = _run_params(max_ft_len, window_size, score_floor, exact_first)
+    if skip_rows is not None:
+        skip_rows = set(skip_rows)
+    if not os.path.exists(out_path):
+        format_streaming(out_path, path=path, chunksize=chunksize, n_process=n_process,
+                            batch_size=batch_size, cache_path=cache_path, 
+                            max_ft_len=max_ft_len, window_size=window_size, 
+                            score_floor=score_floor, exact_first=exact_first,
+                            profile_path=profile_path, errors_path=errors_path,
+                            skip_rows=skip_rows)
+        documents = read_data.load_table(out_path, read_data.DOCUMENTS_FILE, 
+                                            columns=["doc_idx"])
+        next_doc_idx = int(documents["doc_idx"].max()) + 1 if documents.shape[0] > 0 else 0
+        _write_updates(out_path, {"params": params, "next_doc_idx": next_doc_idx, 
+                                  "updates": []})
+        return
+
+    updates = read_data.read_updates(out_path)
+    if updates is None or updates["params"] != params:
+        raise ValueError("{0} was not formatted incrementally with these parameters; "
+                         "re-format it from scratch".format(out_path))
+
+    documents = read_data.load_table(out_path, read_data.DOCUMENTS_FILE, 
+                                        columns=["doc_id", "content_hash"])
+    # doc_idx values of the studies we have, by (uid, content hash) 
+    # (lists, since the CSV may hold identical rows)
+    doc_idxs_for = collections.defaultdict(list)
+    for doc_idx, doc_id, content_hash in zip(documents["doc_idx"], documents["doc_id"], 
+                                                documents["content_hash"]):
+        doc_idxs_for[(_uid_key(doc_id), content_hash)].append(doc_idx)
+
+    counts = {"new": 0, "unchanged": 0}
+    def new_studies():
+        for studies in read_data.iter_studies(path, chunksize=chunksize):
+            if skip_rows is not None:
+                studies = studies[~studies.index.isin(skip_rows)]
+            is_new = []
+            for _, row in studies.iterrows():
+                known = doc_idxs_for.get((_uid_key(row["uid"]), get_content_hash(row)))
+                is_new.append(not known)
+                if known:
+                    known.pop()
+            studies = studies[is_new]
+            # fresh doc_idx values, so as not to clash with existing ones
+            start = updates["next_doc_idx"] + counts["new"]
+            studies.index = pd.RangeIndex(start, start + studies.shape[0])
+            counts["new"] += studies.shape[0]
+            counts["unchanged"] += len(is_new) - studies.shape[0]
+            yield studies
+
+    profiler = RoB_profiling.StageProfiler()
+    quote_errors = []
+    sentence_cache = None
+    if cache_path is not None:
+        sentence_cache = open_sentence_cache(cache_path)
+
+    update_name = "update-{0:05d}".format(len(updates["updates"]) + 1)
+    update_path = os.path.join(out_path, "updates", update_name)
+    formatted = iter_formatted(new_studies(), n_process=n_process, batch_size=batch_size,
+                                flush_every=chunksize, sentence_cache=sentence_cache,
+                                max_ft_len=max_ft_len, window_size=window_size,
+                                score_floor=score_floor, exact_first=exact_first,
+                                profiler=profiler, quote_errors=quote_errors)
+    if not os.path.exists(os.path.dirname(update_path)):
+        os.makedirs(os.path.dirname(update_path))
+    write_stream(formatted, update_path, score_floor=score_floor, profiler=profiler)
+    if counts["new"] == 0:
+        shutil.rmtree(update_path)
+
+    # whatever was not matched by a study in the CSV is gone (or changed)
+    removed = sorted(int(doc_idx) for doc_idxs in doc_idxs_for.values() 
+                        for doc_idx in doc_idxs)
+    if counts["new"] > 0 or len(removed) > 0:
+        updates["updates"].append({"name": update_name, "n_documents": counts["new"],
+                                   "removed": removed})
+        updates["next_doc_idx"] += counts["new"]
+        _write_updates(out_path, updates)
+    print("{0} new or changed studies, {1} unchanged, {2} removed".format(
+                counts["new"], counts["unchanged"], len(removed)))
+    report_quote_errors(quote_errors, errors_path, profiler=profiler)
+
+    if sentence_cache is not None:
+        profiler.info["sentence_cache"] = sentence_cache.stats()
+        sentence_cache.close()
+    profiler.report(profile_path)
+
+
+def _write_updates(out_path, updates):
+    updates_path = os.path.join(out_path, read_data.UPDATES_FILE)
+    with open(updates_path + ".tmp", "w") as updates_f:
+        json.dump(updates, updates_f, indent=1, sort_keys=True)
+    os.replace(updates_path + ".tmp", updates_path)
+
+
+def _shard_name(shard_idx):
+    return "shard-{0:05d}".format(shard_idx)
+
+
+def _run_params(max_ft_len, window_size, score_floor, exact_first):
+    ''' the parameters that affect formatted output '''
+    return {"max_ft_len": max_ft_len, "window_size": window_size, 
+            "window_overlap": WINDOW_OVERLAP, "score_floor": score_floor, 
+            "exact_first": exact_first, "spacy_model": model_id(),
+            "format_version": FORMAT_VERSION}
+
+
+def _hash_run(path, params):
+    '''
+    Key identifying a formatting run: a hash of the input file and of
+    every parameter that affects the output.
+    '''
+    h = hashlib.sha1()
+    with open(path, "rb") as input_f:
+        for block in iter(lambda: input_f.read(1 << 20), b""):
+            h.update(block)
+    h.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _read_manifest(run_dir):
+    manifest_path = os.path.join(run_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as manifest_f:
+        return json.load(manifest_f)
+
+
+def _write_manifest(run_dir, manifest):
+    # write-then-rename, so a crash never leaves a truncated manifest
+    manifest_path = os.path.join(run_dir, "manifest.json")
+    with open(manifest_path + ".tmp", "w") as manifest_f:
+        json.dump(manifest, manifest_f, indent=1, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def _format_shard(task):
+    (studies, shard_idx, shard_path, cache_path, 
+        max_ft_len, window_size, score_floor, exact_first) = task
+    profiler = RoB_profiling.StageProfiler()
+    quote_errors = []
+    # each worker opens its own connection to the (shared) cache
+    sentence_cache = None
+    if cache_path is not None:
+        sentence_cache = open_sentence_cache(cache_path)
+
+    documents, sentences, scores = convert_df_to_training_data(studies=studies, 
+                                                        normalized=True,
+                                                        sentence_cache=sentence_cache,
+                                                        max_ft_len=max_ft_len, 
+                                                        window_size=window_size,
+                                                        score_floor=score_floor,
+                                                        exact_first=exact_first,
+                                                        profiler=profiler,
+                                                        quote_errors=quote_errors)
+    write_normalized(documents, sentences, scores, shard_path, score_floor=score_floor,
+                        profiler=profiler)
+    # kept with the shard, so they are reported even if it is not re-run
+    report_quote_errors(quote_errors, os.path.join(shard_path, QUOTE_ERRORS_FILE))
+
+    if sentence_cache is not None:
+        sentence_cache.close()
+    return shard_idx, documents.shape[0], sentences.shape[0], profiler.totals()
+
+
+def format_in_shards(out_path, path=data_path, shard_dir="data/shards",
+                        shard_size=500, n_jobs=1, cache_path=None, 
+                        max_ft_len=MAX_FT_LEN, window_size=None, score_floor=SCORE_FLOOR,
+                        exact_first=False, profile_path=None, errors_path=None,
+                        skip_rows=None):
+    '''
+    Format the RoB CSV at path in shards of shard_size studies, across
+    n_jobs worker processes, then merge the shards into out_path (see
+    write_stream).
+
+    Completed shards are recorded in a manifest under shard_dir, keyed
+    by a hash of the input and parameters; re-running the same job
+    (e.g., after a crash) only formats the shards still missing. The
+    input is read a shard at a time, with at most 2 * n_jobs shards in
+    flight. cache_path optionally names a sentence boundary cache
+    (see RoB_sentence_cache) shared by the workers.
+
+    As for format_streaming, a profile of the run is printed (and saved
+    to profile_path; stage times are summed over the workers),
+    unparsable quotes are listed in errors_path, and skip_rows are not
+    formatted (shards are still cut from shard_size rows of the CSV).
+    '''
+    profiler = RoB_profiling.StageProfiler()
+    # (loads the parser before forking workers, so they share it)
+    params = dict(_run_params(max_ft_len, window_size, score_floor, exact_first),
+                  shard_size=shard_size)
+    if skip_rows is not None:
+        skip_rows = set(skip_rows)
+        skip_key = json.dumps(sorted(int(row) for row in skip_rows))
+        params["skip_rows"] = hashlib.sha1(skip_key.encode("utf-8")).hexdigest()
+    run_key = _hash_run(path, params)
+    run_dir = os.path.join(shard_dir, run_key[:16])
+    if not os.path.exists(run_dir):
+        os.makedirs(run_dir)
+
+    manifest = _read_manifest(run_dir)
+    if manifest is None:
+        manifest = {"run_key": run_key, "params": params, "shards": {}}
+
+    def record(result):
+        shard_idx, n_docs, n_sents, shard_profile = result
+        profiler.merge(shard_profile)
+        manifest["shards"][_shard_name(shard_idx)] = {"n_documents": n_docs,
+                                                      "n_sentences": n_sents,
+                                                      "seconds": shard_profile["seconds"]}
+        _write_manifest(run_dir, manifest)
+        print("finished {0}".format(_shard_name(shard_idx)))
+
+    pool = None
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs)
+    pending = collections.deque()
+
+    shard_paths, n_skipped = [], 0
+    try:
+        study_chunks = read_data.iter_studies(path, chunksize=shard_size)
+        for shard_idx, studies in enumerate(study_chunks):
+            shard_paths.append(os.path.join(run_dir, _shard_name(shard_idx)))
+            if _shard_name(shard_idx) in manifest["shards"]:
+                n_skipped += 1
+                continue
+            if skip_rows is not None:
+                studies = studies[~studies.index.isin(skip_rows)]
+
+            task = (studies, shard_idx, shard_paths[-1], cache_path, 
+                        max_ft_len, window_size, score_floor, exact_first)
+            if pool is None:
+                record(_format_shard(task))
+            else:
+                pending.append(pool.apply_async(_format_shard, (task,)))
+                while len(pending) >= 2 * n_jobs:
+                    record(pending.popleft().get())
+
+        while len(pending) > 0:
+            record(pending.popleft().get())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    print("{0} of {1} shards were already formatted".format(n_skipped, len(shard_paths)))
+    merge_shards(shard_paths, out_path, score_floor=score_floor, profiler=profiler)
+    quote_errors = [pd.read_csv(os.path.join(shard_path, QUOTE_ERRORS_FILE)) 
+                        for shard_path in shard_paths]
+    report_quote_errors(quote_errors, errors_path, profiler=profiler)
+    profiler.report(profile_path)
+
+
+def merge_shards(shard_paths, out_path, compression="zstd", score_floor=SCORE_FLOOR,
+                    profiler=None):
     '''
-    Assemble data for testing
+    Merge shards (normalized directories, in order) into out_path,
+    appending one shard at a time so only a single shard is ever in
+    memory.
     '''
-    orig_df = pd.read_csv("data/RoB-data-w-uids.csv")
-    duplicate_uids = []
-    for idx, row in orig_df.iterrows():
-        cur_cdno = row['cdno']
-        cur_uid = row['uid']
-        # duplicates are studies w/same uid but in *different*
-        # review
-        cur_duplicates = orig_df[(orig_df['uid'] == cur_uid) & (orig_df['cdno'] != cur_cdno)]
-        if len(cur_duplicates) > 0:
-            duplicate_uids.append(cur_uid)
+    if profiler is None:
+        profiler = RoB_profiling.StageProfiler()
+    shards = (read_data.load_normalized(shard_path) + (read_data.load_scores(shard_path),)
+                for shard_path in shard_paths)
+    shards = profiler.iter_stage("read_shards", shards)
+    write_stream(shards, out_path, compression=compression, score_floor=score_floor,
+                    profiler=profiler)
+
+
+def main(output_format="csv", shard_size=None, n_jobs=1, chunksize=1000, n_process=1,
+            cache_path="data/sentence-cache.sqlite", truncate=True, 
+            profile_path="data/format-profile.json", errors_path="data/quote-errors.csv",
+            incremental=False, exact_first=False, skip_near_dups=None):
+    # without truncation, long texts are segmented in windows instead
+    max_ft_len, window_size = MAX_FT_LEN, None
+    if not truncate:
+        max_ft_len, window_size = None, WINDOW_SIZE
+
+    # studies whose full texts are at least skip_near_dups similar to an
+    # earlier study's are not formatted again
+    skip_rows = None
+    if skip_near_dups is not None:
+        study_chunks = read_data.iter_studies(data_path, chunksize=chunksize, 
+                                                usecols=["uid"])
+        _, pairs = RoB_dedup.near_duplicate_groups(study_chunks, threshold=skip_near_dups)
+        skip_rows = RoB_dedup.redundant_rows(pairs)
+        print("skipping {0} near-duplicate studies".format(len(skip_rows)))
+
+    out_path = "RoB-data-4.csv" if output_format == "csv" else "RoB-data-4"
+    if incremental:
+        if output_format == "csv":
+            raise ValueError("only the normalized layout can be updated incrementally; "
+                             "use output_format='parquet'")
+        format_incremental(out_path, chunksize=chunksize, n_process=n_process,
+                            cache_path=cache_path, max_ft_len=max_ft_len, 
+                            window_size=window_size, exact_first=exact_first,
+                            profile_path=profile_path, errors_path=errors_path,
+                            skip_rows=skip_rows)
+    elif shard_size is not None:
+        format_in_shards(out_path, shard_size=shard_size, n_jobs=n_jobs, 
+                            cache_path=cache_path, max_ft_len=max_ft_len, 
+                            window_size=window_size, exact_first=exact_first,
+                            profile_path=profile_path, errors_path=errors_path,
+                            skip_rows=skip_rows)
+    else:
+        format_streaming(out_path, chunksize=chunksize, n_process=n_process, 
+                            cache_path=cache_path, max_ft_len=max_ft_len, 
+                            window_size=window_size, exact_first=exact_first,
+                            profile_path=profile_path, errors_path=errors_path,
+                            skip_rows=skip_rows)
 
-    return list(set(duplicate_uids))
+
+
+def train_dev_test_split(RA_CNN_data_path="data/RoB-data-3-all.csv"):
+    # see RoB_splits for the details (and a command line interface)
+    return RoB_splits.build_splits(RA_CNN_data_path, studies_path=data_path)
+
+
+def get_duplicate_ids():
+    '''
+    Assemble data for testing: uids of studies that appear in more
+    than one review.
+    '''
+    orig_df = pd.read_csv("data/RoB-data-w-uids.csv", usecols=["uid", "cdno"])
+    return RoB_splits.get_duplicate_ids(orig_df)
 
 if __name__ == "__main__": 
-    main()
+    parser = optparse.OptionParser()
+
+    parser.add_option('-f', '--format', dest="output_format",
+        help="output format: csv (flat) or parquet (normalized)", default="csv")
+
+    parser.add_option('--ss', '--shard-size', dest="shard_size",
+        help="format in shards of this many studies (resumable)", default=None, type="int")
+
+    parser.add_option('--nj', '--n-jobs', dest="n_jobs",
+        help="number of shards to format in parallel", default=1, type="int")
+
+    parser.add_option('--cs', '--chunksize', dest="chunksize",
+        help="number of studies to read (and write) at a time", default=1000, type="int")
+
+    parser.add_option('--np', '--n-process', dest="n_process",
+        help="number of processes for sentence segmentation", default=1, type="int")
+
+    parser.add_option('--nt', '--no-truncate', dest="truncate",
+        help="segment long full texts in windows, rather than truncating them",
+        action='store_false', default=True)
+
+    parser.add_option('--inc', '--incremental', dest="incremental",
+        help="only format studies that are new or changed (normalized output only)",
+        action='store_true', default=False)
+
+    parser.add_option('--ef', '--exact-first', dest="exact_first",
+        help="label the sentences spanned by quotes found verbatim without fuzzy matching",
+        action='store_true', default=False)
+
+    parser.add_option('--snd', '--skip-near-dups', dest="skip_near_dups",
+        help="skip studies with full texts at least this similar (0-1) to an earlier one's",
+        default=None, type="float")
+
+    (options, args) = parser.parse_args()
+    main(output_format=options.output_format, shard_size=options.shard_size, 
+            n_jobs=options.n_jobs, chunksize=options.chunksize, n_process=options.n_process,
+            truncate=options.truncate, incremental=options.incremental, 
+            exact_first=options.exact_first, skip_near_dups=options.skip_near_dups)
 
@@ -0,0 +1,252 @@
+'''
+Matching of quoted rationales to the sentences of a full text.
+
+The original matcher (RoB_format_data.is_sent_match) calls
+fuzz.token_sort_ratio once for every sentence x rationale pair. Here
+we instead (1) normalize each string once, (2) use a cheap character
+histogram bound to discard pairs that cannot possibly reach the
+threshold and (3) score only the surviving pairs, in batch where
+possible. The labels produced are identical to those of is_sent_match.
+
+score_rationales keeps the scores themselves (above some floor), so
+that labels for other thresholds can be derived without re-scoring.
+Quotes are often repeated across a study's domains and outcome types
+(and sentences within a text), so each distinct normalized quote is
+scored against each distinct normalized sentence only once.
+
+find_quotes locates quotes verbatim in the full text instead (see
+below), which gives their character offsets.
+'''
+
+import numpy as np
+
+from fuzzywuzzy import fuzz, utils
+
+try:
+    from rapidfuzz import process as rf_process
+    from rapidfuzz import fuzz as rf_fuzz
+except ImportError:
+    rf_process = None
+
+# rapidfuzz's ratio is the same (Levenshtein-based) measure fuzzywuzzy
+# uses when python-Levenshtein is installed; but if fuzzywuzzy has
+# fallen back on difflib the scores differ, so we only batch score via
+# rapidfuzz in the former case.
+USE_RAPIDFUZZ = (rf_process is not None and
+                    fuzz.SequenceMatcher.__module__ == "fuzzywuzzy.StringMatcher")
+
+
+def sort_tokens(text):
+    '''
+    Normalize text exactly as fuzz.token_sort_ratio does internally:
+    strip non-alphanumerics, lowercase and sort the tokens.
+    '''
+    processed = utils.full_process(text, force_ascii=True)
+    return " ".join(sorted(processed.split())).strip()
+
+
+def char_histograms(keys):
+    '''
+    (len(keys) x 128) matrix of character counts. Normalized keys are
+    nearly all ASCII; anything beyond that shares the last bin, which
+    can only loosen (never break) the bound computed below.
+    '''
+    H = np.zeros((len(keys), 128), dtype=np.int32)
+    for idx, key in enumerate(keys):
+        codes = np.fromiter(map(ord, key), dtype=np.int64, count=len(key))
+        H[idx] = np.bincount(np.minimum(codes, 127), minlength=128)
+    return H
+
+
+def candidate_mask(quote_keys, sent_keys, threshold=90):
+    '''
+    Returns a boolean (quotes x sentences) matrix flagging the pairs
+    that *may* score >= threshold.
+
+    The similarity used by token_sort_ratio is 2*M / (len(a) + len(b)),
+    where M (the number of matched characters) can never exceed the
+    number of characters the two strings have in common. So the
+    overlap of character histograms gives an upper bound on the score;
+    pairs whose bound falls short of the threshold are pruned without
+    running the expensive comparison.
+    '''
+    Q, S = char_histograms(quote_keys), char_histograms(sent_keys)
+    q_lens, s_lens = Q.sum(axis=1), S.sum(axis=1)
+    lens = q_lens[:, None] + s_lens[None, :]
+
+    common = np.zeros(lens.shape, dtype=np.int32)
+    for i in range(Q.shape[0]):
+        common[i] = np.minimum(Q[i][None, :], S).sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        upper_bound = np.where(lens > 0, 200.0 * common / lens, 100.0)
+
+    # scores are rounded to integers, hence the .5 slack
+    return upper_bound >= (threshold - 0.5)
+
+
+def score_pairs(quote_keys, sent_keys, mask):
+    '''
+    token_sort_ratio scores for the (already normalized) pairs flagged
+    in mask; pruned pairs are left at 0.
+    '''
+    scores = np.zeros(mask.shape, dtype=np.int32)
+    if not mask.any():
+        return scores
+
+    if USE_RAPIDFUZZ:
+        # score only the sentences that survived for at least one quote
+        q_idx = np.where(mask.any(axis=1))[0]
+        s_idx = np.where(mask.any(axis=0))[0]
+        q_batch = np.array([quote_keys[i] for i in q_idx], dtype=object)
+        s_batch = np.array([sent_keys[j] for j in s_idx], dtype=object)
+        batch = rf_process.cdist(list(q_batch), list(s_batch),
+                                 scorer=rf_fuzz.ratio, dtype=np.float64)
+        # fuzzywuzzy rounds to the nearest integer
+        batch = np.round(batch)
+
+        # mirror fuzzywuzzy's special cases: identical strings
+        # score 100, and otherwise an empty string scores 0.
+        empty = np.logical_or.outer(q_batch == "", s_batch == "")
+        batch[empty] = 0
+        batch[q_batch[:, None] == s_batch[None, :]] = 100
+
+        scores[np.ix_(q_idx, s_idx)] = batch.astype(np.int32)
+        scores[~mask] = 0
+    else:
+        for i, j in zip(*np.where(mask)):
+            scores[i, j] = fuzz.ratio(quote_keys[i], sent_keys[j])
+
+    return scores
+
+
+def _unique_keys(keys):
+    '''
+    Distinct keys (in order of first appearance) and, for each of the
+    keys, the index of its distinct key.
+    '''
+    index_of, inverse = {}, np.empty(len(keys), dtype=np.int64)
+    for idx, key in enumerate(keys):
+        inverse[idx] = index_of.setdefault(key, len(index_of))
+    return list(index_of), inverse
+
+
+def score_rationales(rationales, sentences, min_score=70):
+    '''
+    token_sort_ratio scores of each of the rationales (None entries are
+    allowed and score 0) against each of the sentences, as an integer
+    (rationales x sentences) matrix. Scores of at least min_score are
+    exact; lower ones are reported as 0, which lets the histogram bound
+    prune most pairs. Unlike match_rationales no min_k filter is
+    applied, so labels for any threshold >= min_score (and any min_k)
+    can be derived from these scores later on.
+    '''
+    scores = np.zeros((len(rationales), len(sentences)), dtype=np.int32)
+    q_idx = [i for i, r in enumerate(rationales) if r is not None]
+    if len(q_idx) == 0 or len(sentences) == 0:
+        return scores
+
+    # token_sort_ratio depends on the normalized strings only
+    quote_keys, q_inverse = _unique_keys([sort_tokens(rationales[i]) for i in q_idx])
+    sent_keys, s_inverse = _unique_keys([sort_tokens(sentence) for sentence in sentences])
+
+    mask = candidate_mask(quote_keys, sent_keys, threshold=min_score)
+    unique_scores = score_pairs(quote_keys, sent_keys, mask)
+    unique_scores[unique_scores < min_score] = 0
+    scores[q_idx] = unique_scores[np.ix_(q_inverse, s_inverse)]
+    return scores
+
+
+def match_rationales(rationales, sentences, threshold=90, min_k=5):
+    '''
+    Match each of the rationales (quotes; None entries are allowed and
+    never match) against each of the sentences. Returns a boolean
+    (rationales x sentences) matrix that agrees with
+
+        is_sent_match(rationales[i], sentences[j], threshold, min_k)
+    '''
+    matches = np.zeros((len(rationales), len(sentences)), dtype=bool)
+
+    # rationales need to be at least k words.
+    long_enough = np.array([len(s.split(" ")) >= min_k for s in sentences], dtype=bool)
+    q_idx = [i for i, r in enumerate(rationales) if r is not None]
+    s_idx = np.where(long_enough)[0]
+    if len(q_idx) == 0 or s_idx.shape[0] == 0:
+        return matches
+
+    quote_keys, q_inverse = _unique_keys([sort_tokens(rationales[i]) for i in q_idx])
+    sent_keys, s_inverse = _unique_keys([sort_tokens(sentences[j]) for j in s_idx])
+
+    mask = candidate_mask(quote_keys, sent_keys, threshold=threshold)
+    scores = score_pairs(quote_keys, sent_keys, mask)
+    matches[np.ix_(q_idx, s_idx)] = (scores >= threshold)[np.ix_(q_inverse, s_inverse)]
+    return matches
+
+
+'''
+Exact alignment of quotes to the full text.
+
+Most "Quote:" rationales are (near) verbatim substrings of the full
+text. Locating them directly gives their character offsets, and the
+sentences they span, without any fuzzy comparisons. Both the text and
+the quotes are first normalized (lowercased, with quote characters
+unified and runs of whitespace collapsed) and the offsets of hits are
+mapped back onto the original text.
+'''
+QUOTE_CHARS = {ord(c): '"' for c in '“”„‟″'}
+QUOTE_CHARS.update({ord(c): "'" for c in '‘’‚‛′'})
+# too short a quote may well be found in the wrong place
+MIN_QUOTE_CHARS = 20
+
+
+def normalize_for_search(text):
+    '''
+    Returns the normalized text and, for each of its characters, the
+    offset of the corresponding character in text.
+    '''
+    normalized = text.translate(QUOTE_CHARS)
+    if len(normalized.lower()) == len(normalized):
+        # (lowercasing a handful of characters changes their length)
+        normalized = normalized.lower()
+
+    codes = np.frombuffer(normalized.encode("utf-32-le"), dtype=np.uint32)
+    is_space = np.isin(codes, [9, 10, 11, 12, 13, 32, 160])
+    # keep the first of each run of whitespace, as a plain space
+    keep = ~(is_space & np.concatenate([[False], is_space[:-1]]))
+    codes = np.where(is_space, 32, codes)[keep].astype("<u4")
+    return codes.tobytes().decode("utf-32-le"), np.nonzero(keep)[0]
+
+
+def find_quotes(quotes, text):
+    '''
+    (start, end) character offsets in text of the first occurrence of
+    each of the quotes, or None for quotes that are missing (or None,
+    or too short to place reliably).
+
+    With at most ten (and usually far fewer distinct) quotes per study,
+    a str.find per quote over the normalized text is as fast as a
+    multi-pattern automaton would be, and needs no extra dependency.
+    '''
+    normalized_text, offsets = normalize_for_search(text)
+    spans, span_for = [], {}
+    for quote in quotes:
+        if quote is not None and quote not in span_for:
+            span_for[quote] = None
+            normalized_quote = normalize_for_search(quote)[0].strip()
+            if len(normalized_quote) >= MIN_QUOTE_CHARS:
+                start = normalized_text.find(normalized_quote)
+                if start >= 0:
+                    end = start + len(normalized_quote)
+                    span_for[quote] = (int(offsets[start]), int(offsets[end - 1]) + 1)
+        spans.append(span_for.get(quote))
+    return spans
+
+
+def sentence_range(span, sent_starts):
+    '''
+    The (first, last) indices of the sentences (starting at the sorted
+    offsets sent_starts) that the character span overlaps.
+    '''
+    first = np.searchsorted(sent_starts, span[0], side="right") - 1
+    last = np.searchsorted(sent_starts, span[1] - 1, side="right") - 1
+    return max(int(first), 0), max(int(last), 0)
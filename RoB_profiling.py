@@ -0,0 +1,143 @@
+'''
+Lightweight instrumentation for the formatting pipeline.
+
+A StageProfiler accumulates the wall time spent in each named stage
+(parsing, quote extraction, matching, ...), the number of documents
+and sentences processed and peak memory use, and summarizes these at
+the end of a run. Time is *exclusive*: while a nested stage runs, the
+enclosing one is paused, so stage times add up to (at most) the total.
+Entering a stage costs a couple of clock reads, so profiling is always
+on.
+'''
+
+import os
+import sys
+import json
+import time
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    # (not available on Windows)
+    resource = None
+
+
+def peak_rss_mb(who="self"):
+    ''' peak resident set size of this process (or its children), in MB '''
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self"
+                                    else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in bytes on macOS, KB elsewhere
+    scale = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0
+    return usage.ru_maxrss / scale
+
+
+class StageProfiler:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds, self.calls = {}, {}
+        self.counts = {"documents": 0, "sentences": 0}
+        # anything else worth reporting (e.g., cache statistics)
+        self.info = {}
+        # [stage name, time it was (last) resumed] of the open stages
+        self._stack = []
+
+    def _add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        now = time.perf_counter()
+        if len(self._stack) > 0:
+            # pause the enclosing stage
+            parent = self._stack[-1]
+            self._add(parent[0], now - parent[1])
+        entry = [name, now]
+        self._stack.append(entry)
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self._stack.pop()
+            self._add(name, now - entry[1])
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if len(self._stack) > 0:
+                self._stack[-1][1] = now
+
+    def iter_stage(self, name, iterable):
+        '''
+        Iterate over iterable, counting the time spent producing each
+        item (e.g., by a generator) towards stage name.
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, documents=0, sentences=0):
+        self.counts["documents"] += documents
+        self.counts["sentences"] += sentences
+
+    def totals(self):
+        ''' raw totals, e.g. to send back from a worker process '''
+        return {"seconds": dict(self.seconds), "calls": dict(self.calls),
+                "counts": dict(self.counts), "peak_rss_mb": peak_rss_mb()}
+
+    def merge(self, totals):
+        ''' add in the totals of another (e.g., a worker's) profiler '''
+        for name, seconds in totals["seconds"].items():
+            self._add(name, seconds)
+        for name, calls in totals["calls"].items():
+            self.calls[name] = self.calls.get(name, 0) + calls
+        self.count(**totals["counts"])
+        if totals.get("peak_rss_mb") is not None:
+            worker_peak = self.info.get("peak_rss_workers_mb") or 0.0
+            self.info["peak_rss_workers_mb"] = max(worker_peak, totals["peak_rss_mb"])
+
+    def summary(self):
+        wall = time.perf_counter() - self.started
+        stages = {}
+        for name in self.seconds:
+            stages[name] = {"seconds": self.seconds[name], "calls": self.calls.get(name, 0),
+                            "share": self.seconds[name] / wall if wall > 0 else 0.0}
+
+        summary = {"wall_seconds": wall, "stages": stages,
+                   # stage times of worker processes overlap, so may
+                   # add up to more than the wall time
+                   "untracked_seconds": max(wall - sum(self.seconds.values()), 0.0),
+                   "documents": self.counts["documents"],
+                   "sentences": self.counts["sentences"],
+                   "documents_per_sec": self.counts["documents"] / wall if wall > 0 else 0.0,
+                   "sentences_per_sec": self.counts["sentences"] / wall if wall > 0 else 0.0,
+                   "peak_rss_mb": peak_rss_mb(),
+                   "peak_rss_children_mb": peak_rss_mb("children")}
+        summary.update(self.info)
+        return summary
+
+    def report(self, path=None):
+        '''
+        Print a summary of the run and, if path is given, also write it
+        there as JSON.
+        '''
+        summary = self.summary()
+        print("formatted {0} documents ({1} sentences) in {2:.1f}s: "
+                "{3:.2f} docs/sec, {4:.1f} sents/sec".format(
+                    summary["documents"], summary["sentences"], summary["wall_seconds"],
+                    summary["documents_per_sec"], summary["sentences_per_sec"]))
+        for name, stage in sorted(summary["stages"].items(),
+                                    key=lambda item: -item[1]["seconds"]):
+            print("  {0}: {1:.2f}s ({2:.1%})".format(name, stage["seconds"], stage["share"]))
+        print("  peak RSS: {0:.1f} MB".format(summary["peak_rss_mb"] or 0.0))
+
+        if path is not None:
+            with open(path + ".tmp", "w") as summary_f:
+                json.dump(summary, summary_f, indent=1, sort_keys=True)
+            os.replace(path + ".tmp", path)
+        return summary
@@ -9,9 +9,9 @@ def get_col_names(domain_str):
     return (domain + "-judgment", domain + "-rationale")    
 
 def load_RoB_df(path_to_csv):
-    tp = pd.read_csv(path_to_csv, chunksize=10000)
-    df = pd.concat(tp, ignore_index=True)
-    return df 
+    # one read, rather than concatenating (copying) chunks of it;
+    # see read_data.iter_studies to stream studies instead
+    return pd.read_csv(path_to_csv)
 
 '''
 Consume RoB data in the CSV; convert to RA-CNN style data.
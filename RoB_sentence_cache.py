@@ -0,0 +1,126 @@
+'''
+Disk-backed cache of sentence boundaries.
+
+Parsing full texts with spaCy dominates the cost of formatting the RoB
+data, but sentence boundaries only change when the text or the parser
+does. So we store, per text, the (start, end) character offsets of its
+sentences, keyed by a hash of the (truncated) text and the spaCy model
+version, in a SQLite database. Re-formatting runs (e.g., with different
+matching thresholds) then only parse texts not seen before.
+'''
+
+import time
+import sqlite3
+import hashlib
+
+import numpy as np
+
+
+class SentenceCache:
+
+    def __init__(self, path, model_id, max_entries=None, max_bytes=None):
+        '''
+        parameters
+        ---
+        path: the SQLite database file (created if need be)
+        model_id: identifies the parser (e.g., model name and version);
+            part of every key, so changing models never returns stale
+            boundaries.
+        max_entries, max_bytes: optional size limits, enforced by evict()
+            by dropping the least recently used entries.
+        '''
+        self.path = path
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS sentences (
+                                key TEXT PRIMARY KEY,
+                                offsets BLOB,
+                                n_bytes INTEGER,
+                                last_used REAL)''')
+        self.conn.execute('''CREATE INDEX IF NOT EXISTS sentences_last_used
+                                ON sentences (last_used)''')
+        self.conn.commit()
+
+    def key(self, text, variant=""):
+        '''
+        variant distinguishes different ways of segmenting the same
+        text with the same model (e.g., in windows).
+        '''
+        h = hashlib.sha1(self.model_id.encode("utf-8"))
+        h.update(b"\0" + variant.encode("utf-8") + b"\0")
+        h.update(text.encode("utf-8"))
+        return h.hexdigest()
+
+    def get_many(self, keys):
+        '''
+        Returns a dict mapping those keys that are cached to their
+        (n_sentences x 2) offset arrays.
+        '''
+        found = {}
+        keys = list(set(keys))
+        # stay under SQLite's limit on query parameters
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start+500]
+            query = "SELECT key, offsets FROM sentences WHERE key IN ({0})".format(
+                            ",".join("?" * len(batch)))
+            for key, offsets in self.conn.execute(query, batch):
+                found[key] = np.frombuffer(offsets, dtype=np.int32).reshape(-1, 2)
+
+        now = time.time()
+        self.conn.executemany("UPDATE sentences SET last_used = ? WHERE key = ?",
+                                [(now, key) for key in found])
+        self.conn.commit()
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        ''' items: (key, offsets) pairs, offsets being (start, end) pairs '''
+        now, rows = time.time(), []
+        for key, offsets in items:
+            blob = np.asarray(offsets, dtype=np.int32).reshape(-1, 2).tobytes()
+            rows.append((key, blob, len(blob), now))
+        self.conn.executemany("INSERT OR REPLACE INTO sentences VALUES (?, ?, ?, ?)", rows)
+        self.conn.commit()
+
+    def size(self):
+        n_entries, n_bytes = self.conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(n_bytes), 0) FROM sentences").fetchone()
+        return n_entries, n_bytes
+
+    def evict(self):
+        '''
+        Drop least recently used entries until the cache is within its
+        limits; returns the number of entries dropped.
+        '''
+        n_entries, n_bytes = self.size()
+        to_drop = []
+        rows = self.conn.execute("SELECT key, n_bytes FROM sentences ORDER BY last_used")
+        for key, entry_bytes in rows:
+            over_entries = self.max_entries is not None and n_entries > self.max_entries
+            over_bytes = self.max_bytes is not None and n_bytes > self.max_bytes
+            if not (over_entries or over_bytes):
+                break
+            to_drop.append((key,))
+            n_entries -= 1
+            n_bytes -= entry_bytes
+
+        self.conn.executemany("DELETE FROM sentences WHERE key = ?", to_drop)
+        self.conn.commit()
+        return len(to_drop)
+
+    def stats(self):
+        n_entries, n_bytes = self.size()
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "entries": n_entries, "bytes": n_bytes}
+
+    def close(self):
+        self.evict()
+        self.conn.close()
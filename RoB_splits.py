@@ -0,0 +1,189 @@
+'''
+Build the train/dev/test splits of the formatted RoB data (this used to
+be done in create-train-test-splits.ipynb).
+
+ - test: studies that appear (same uid) in more than one Cochrane
+   review; these were assessed independently more than once.
+ - train and dev: everything else, minus 'edge cases' -- studies with
+   inconsistent judgments for some domain (despite being within the
+   same review, by construction). dev is a random sample of (by default)
+   5000 of these, drawn with a fixed seed, so that the splits are
+   reproducible.
+
+Optionally, studies whose full texts are near duplicates (see
+RoB_dedup) are treated as the same study: such a group is kept
+together in a single split.
+
+Usage:
+
+    python RoB_splits.py -i data/RoB-data-4.csv -o data/splits
+'''
+
+import os
+import optparse
+
+import numpy as np
+import pandas as pd
+
+import read_data
+import RoB_dedup
+
+
+DOC_JUDGMENTS = ['rsg-doc-judgment',
+                 'ac-doc-judgment',
+                 'bpp-doc-judgment-all',
+                 'bpp-doc-judgment-mortality',
+                 'bpp-doc-judgment-objective',
+                 'bpp-doc-judgment-subjective',
+                 'boa-doc-judgment-all',
+                 'boa-doc-judgment-objective',
+                 'boa-doc-judgment-subjective',
+                 'boa-doc-judgment-mortality']
+
+
+def get_duplicate_ids(studies):
+    '''
+    uids of studies that appear in more than one review (cdno), in a
+    single groupby rather than a scan of the data per study.
+
+    As in the original row-by-row check, a missing cdno differs from
+    every cdno, itself included: a uid with a missing cdno on any of
+    its rows counts as a duplicate, even if it has just the one row.
+    '''
+    studies = studies.dropna(subset=["uid"])
+    n_reviews = studies.groupby("uid")["cdno"].nunique(dropna=False)
+    has_missing = studies["cdno"].isnull().groupby(studies["uid"]).any()
+    duplicated = (n_reviews > 1) | has_missing
+    return list(duplicated.index[duplicated.values])
+
+
+def find_edge_case_ids(formatted, doc_judgments=DOC_JUDGMENTS):
+    '''
+    doc_ids of documents with more than one distinct value (missing
+    counts as a value) for any of the doc_judgments.
+    '''
+    n_values = formatted.groupby("doc_id")[doc_judgments].nunique(dropna=False)
+    inconsistent = (n_values > 1).any(axis=1)
+    return list(inconsistent.index[inconsistent.values])
+
+
+def _has_id(formatted, ids):
+    # uids may have been read as numbers in one file and strings in another
+    return formatted["doc_id"].astype(str).isin(set(str(uid) for uid in ids))
+
+
+def expand_to_groups(ids, group_of):
+    '''
+    ids, plus all uids in the same group (group_of maps uids to
+    group labels, as from RoB_dedup.near_duplicate_groups) as any of them.
+    '''
+    group_of = {str(uid): group for uid, group in group_of.items()}
+    groups = set(group_of.get(str(uid)) for uid in ids) - set([None])
+    members = set(uid for uid, group in group_of.items() if group in groups)
+    return sorted(members | set(str(uid) for uid in ids))
+
+
+def make_splits(formatted, test_ids, n_dev=5000, seed=1337, doc_judgments=DOC_JUDGMENTS,
+                    group_of=None):
+    '''
+    Split formatted data (flat layout, one row per sentence) into
+    (train, dev, test) DataFrames. test holds the documents whose
+    doc_id is in test_ids; edge cases are dropped from the rest, of
+    which n_dev documents (sampled with the given seed) make up dev.
+
+    If group_of (uid -> group label) is given, each group of documents
+    ends up in a single split.
+    '''
+    formatted = formatted[pd.notnull(formatted["doc_id"])]
+    if group_of is not None:
+        test_ids = expand_to_groups(test_ids, group_of)
+    in_test = _has_id(formatted, test_ids)
+    test_df, train_df = formatted[in_test], formatted[~in_test]
+
+    edge_cases = find_edge_case_ids(train_df, doc_judgments=doc_judgments)
+    print("dropping {0} documents with inconsistent judgments".format(len(edge_cases)))
+    train_df = train_df[~_has_id(train_df, edge_cases)]
+
+    train_uids = train_df["doc_id"].unique()
+    random_state = np.random.RandomState(seed)
+    dev_ids = random_state.choice(train_uids, min(n_dev, len(train_uids)), replace=False)
+    if group_of is not None:
+        dev_ids = expand_to_groups(dev_ids, group_of)
+    in_dev = _has_id(train_df, dev_ids)
+    return train_df[~in_dev], train_df[in_dev], test_df
+
+
+def build_splits(formatted_path, studies_path="data/RoB-data-w-uids.csv",
+                    out_dir="data/splits", n_dev=5000, seed=1337, near_dup_threshold=None,
+                    chunksize=1000):
+    '''
+    Read the raw studies (for uids and review numbers) and the formatted
+    data (CSV or normalized directory), and write train-df.csv,
+    dev-df.csv and test-df.csv to out_dir.
+
+    If near_dup_threshold is given, studies whose full texts have (an
+    estimated) Jaccard similarity at least that high are kept in the
+    same split; the pairs found are written to near-duplicates.csv.
+    Full texts are read chunksize studies at a time.
+    '''
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    group_of = None
+    studies = pd.read_csv(studies_path, usecols=["uid", "cdno"])
+    if near_dup_threshold is not None:
+        study_chunks = read_data.iter_studies(studies_path, chunksize=chunksize,
+                                                usecols=["uid"])
+        group_of, pairs = RoB_dedup.near_duplicate_groups(study_chunks, 
+                                                            threshold=near_dup_threshold)
+        print("{0} pairs of near-duplicate full texts".format(len(pairs)))
+        pairs = pd.DataFrame(pairs, columns=["row_i", "row_j", "similarity"])
+        pairs["uid_i"] = studies["uid"].loc[pairs["row_i"]].values
+        pairs["uid_j"] = studies["uid"].loc[pairs["row_j"]].values
+        pairs.to_csv(os.path.join(out_dir, "near-duplicates.csv"), index=False)
+
+    test_ids = get_duplicate_ids(studies)
+    print("{0} uids appear in more than one review".format(len(test_ids)))
+
+    formatted = read_data.load_formatted_df(formatted_path)
+    splits = make_splits(formatted, test_ids, n_dev=n_dev, seed=seed, group_of=group_of)
+
+    for name, split_df in zip(["train", "dev", "test"], splits):
+        split_path = os.path.join(out_dir, "{0}-df.csv".format(name))
+        print("{0}: {1} documents, {2} sentences -> {3}".format(
+                name, split_df["doc_id"].nunique(), split_df.shape[0], split_path))
+        split_df.to_csv(split_path, index=False)
+    return splits
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+
+    parser.add_option('-i', '--input', dest="formatted_path",
+        help="formatted data (CSV, or directory of normalized data)",
+        default="RoB-data-4.csv")
+
+    parser.add_option('-s', '--studies', dest="studies_path",
+        help="raw RoB data, with uids and review numbers (cdno)",
+        default="data/RoB-data-w-uids.csv")
+
+    parser.add_option('-o', '--out-dir', dest="out_dir",
+        help="where to write {train,dev,test}-df.csv",
+        default="data/splits")
+
+    parser.add_option('--nd', '--n-dev', dest="n_dev",
+        help="number of documents in the development set",
+        default=5000, type="int")
+
+    parser.add_option('--seed', dest="seed",
+        help="random seed for sampling the development set",
+        default=1337, type="int")
+
+    parser.add_option('--ndt', '--near-dup-threshold', dest="near_dup_threshold",
+        help="keep studies with full texts at least this similar (0-1) in the same split",
+        default=None, type="float")
+
+    (options, args) = parser.parse_args()
+    build_splits(options.formatted_path, studies_path=options.studies_path,
+                    out_dir=options.out_dir, n_dev=options.n_dev, seed=options.seed,
+                    near_dup_threshold=options.near_dup_threshold)
@@ -1,2 +1,192 @@
+import os
+import json
+
+import numpy as np
 import pandas as pd
 
+'''
+Formatted RoB data comes in one of two layouts:
+
+ - flat: a single CSV with one row per sentence, in which every
+   document-level field (pmid, doi, judgments) is repeated on each
+   of the document's sentence rows.
+ - normalized: a directory holding a documents table (one row per
+   study) and a sentences table (one row per sentence), both stored
+   as Parquet and joined on doc_idx.
+
+The normalized layout also keeps a (sparse) scores table: the raw
+similarity of each (sentence, rationale field) pair scoring at least
+some floor, from which rationale labels for other thresholds can be
+derived (see label_rationales).
+
+Normalized data kept up to date incrementally (see
+RoB_format_data.format_incremental) has, besides these base tables,
+an updates/ directory holding one set of tables per update, and a
+manifest (updates.json) listing the updates and the documents each
+removed. Readers see the union of the base and updates, minus the
+removed documents.
+'''
+DOCUMENTS_FILE = "documents.parquet"
+SENTENCES_FILE = "sentences.parquet"
+SCORES_FILE = "scores.parquet"
+UPDATES_FILE = "updates.json"
+
+
+def iter_studies(path, chunksize=1000, usecols=None):
+    '''
+    Stream the raw RoB CSV (one row per study) in chunks of chunksize
+    studies, skipping those for which we have no full text. usecols
+    optionally restricts the columns read (fulltext is always read).
+    '''
+    if usecols is not None:
+        usecols = list(usecols) + [col for col in ["fulltext"] if col not in usecols]
+    for studies in pd.read_csv(path, chunksize=chunksize, usecols=usecols):
+        yield studies.dropna(subset=["fulltext"])
+
+
+def load_studies(path):
+    '''
+    All studies (with full texts) in the raw RoB CSV, in one DataFrame.
+    '''
+    studies = pd.read_csv(path)
+    return studies.dropna(subset=["fulltext"])
+
+
+def is_normalized(path):
+    return os.path.isdir(path)
+
+
+def denormalize(documents, sentences):
+    '''
+    Join the document table onto the sentence table, recovering the
+    flat (one row per sentence) layout.
+    '''
+    flat = sentences.merge(documents, on="doc_idx", how="left", sort=False)
+    return flat.reset_index(drop=True)
+
+
+def read_updates(path):
+    ''' the updates manifest of normalized data at path (None if none) '''
+    updates_path = os.path.join(path, UPDATES_FILE)
+    if not os.path.exists(updates_path):
+        return None
+    with open(updates_path) as updates_f:
+        return json.load(updates_f)
+
+
+def load_table(path, table_file, columns=None):
+    '''
+    Read one of the tables (e.g., DOCUMENTS_FILE) of normalized data,
+    including any incremental updates.
+    '''
+    if columns is not None:
+        columns = ["doc_idx"] + [c for c in columns if c != "doc_idx"]
+
+    part_paths, removed = [path], set()
+    updates = read_updates(path)
+    if updates is not None:
+        for update in updates["updates"]:
+            if update["n_documents"] > 0:
+                part_paths.append(os.path.join(path, "updates", update["name"]))
+            removed.update(update["removed"])
+
+    parts = [pd.read_parquet(os.path.join(part_path, table_file), columns=columns)
+                for part_path in part_paths]
+    table = parts[0] if len(parts) == 1 else pd.concat(parts, ignore_index=True)
+    if len(removed) > 0:
+        table = table[~table["doc_idx"].isin(removed)].reset_index(drop=True)
+    return table
+
+
+def load_normalized(path, doc_columns=None, sentence_columns=None):
+    '''
+    Read the documents and sentences tables under path. If given,
+    doc_columns and sentence_columns restrict what is read (the join
+    key is always included).
+    '''
+    documents = load_table(path, DOCUMENTS_FILE, columns=doc_columns)
+    sentences = load_table(path, SENTENCES_FILE, columns=sentence_columns)
+    return documents, sentences
+
+
+def load_scores(path):
+    ''' the scores table under (normalized) path '''
+    return load_table(path, SCORES_FILE)
+
+
+def get_score_floor(path):
+    ''' the lowest score kept in the scores table under path '''
+    import pyarrow.parquet as pq
+    metadata = pq.read_schema(os.path.join(path, SCORES_FILE)).metadata or {}
+    return int(metadata.get(b"score_floor", 0))
+
+
+def label_rationales(sentences, scores, threshold=90, min_k=5):
+    '''
+    Re-derive the rationale label columns of the sentences table from
+    the raw scores: a sentence is labeled a rationale for a field if it
+    scores at least threshold against the field's quote and has at
+    least min_k words (as in RoB_format_data.is_sent_match). sentences
+    must include the sent_idx and n_words columns. Nothing is re-parsed
+    or re-scored, so this is cheap enough to sweep thresholds with.
+
+    Data formatted with exact_first (see RoB_format_data.format_study)
+    flags the pairs whose score of 100 comes from a verbatim quote
+    match rather than from fuzzy matching; their number is reported.
+    '''
+    sentences = sentences.copy()
+    positions = pd.Series(np.arange(sentences.shape[0]),
+                            index=pd.MultiIndex.from_arrays([sentences["doc_idx"],
+                                                             sentences["sent_idx"]]))
+    hits = scores[scores["score"] >= threshold]
+    if "exact" in hits.columns and hits["exact"].any():
+        print("{0} of {1} rationale scores at or above {2} are verbatim quote matches".format(
+                int(hits["exact"].sum()), hits.shape[0], threshold))
+    rows = positions.reindex(pd.MultiIndex.from_arrays([hits["doc_idx"],
+                                                        hits["sent_idx"]])).to_numpy()
+    # (scores may cover sentences that were not loaded)
+    found = ~np.isnan(rows)
+    long_enough = (sentences["n_words"] >= min_k).to_numpy()
+
+    fields = hits["field"].astype(str).to_numpy()
+    for col in [col for col in sentences.columns if "-rationale" in col]:
+        labels = np.zeros(sentences.shape[0], dtype=np.int8)
+        labels[rows[found & (fields == col)].astype(np.int64)] = 1
+        sentences[col] = labels * long_enough
+    return sentences
+
+
+def load_formatted_df(path, doc_columns=None, sentence_columns=None,
+                        threshold=None, min_k=None):
+    '''
+    Returns formatted data in the flat layout, whichever way it is
+    stored on disk. If doc_columns or sentence_columns are given, only
+    those columns are read.
+
+    If threshold or min_k are given, rationale labels are re-derived
+    from the raw scores for those settings (defaulting to 90 and 5);
+    this needs the normalized layout.
+    '''
+    relabel = threshold is not None or min_k is not None
+    if relabel and not is_normalized(path):
+        raise ValueError("relabeling needs the normalized layout (with raw scores)")
+
+    if is_normalized(path):
+        if relabel and sentence_columns is not None:
+            sentence_columns = list(sentence_columns) + ["sent_idx", "n_words"]
+        documents, sentences = load_normalized(path, doc_columns=doc_columns,
+                                                sentence_columns=sentence_columns)
+        if relabel:
+            threshold = 90 if threshold is None else threshold
+            min_k = 5 if min_k is None else min_k
+            if threshold < get_score_floor(path):
+                raise ValueError("scores under {0} were not kept; cannot label at {1}".format(
+                                    get_score_floor(path), threshold))
+            sentences = label_rationales(sentences, load_scores(path),
+                                            threshold=threshold, min_k=min_k)
+        return denormalize(documents, sentences)
+
+    usecols = None
+    if doc_columns is not None or sentence_columns is not None:
+        usecols = list(doc_columns or []) + list(sentence_columns or [])
+    return pd.read_csv(path, usecols=usecols)
@@ -0,0 +1,70 @@
+'''
+Shapes of the (length bucketed) batches fed to the RA-CNN models.
+
+    python -m pytest test_RA_CNN_batches.py
+'''
+
+import numpy as np
+
+import RA_CNN_redux
+from RA_CNN_redux import Corpus, CorpusBatches, BalancedSentenceBatches, Document
+
+
+MAX_DOC_LEN, MAX_SENT_LEN = 20, 6
+
+
+def make_corpus():
+    random_state = np.random.RandomState(0)
+    words = ["trial", "random", "blind", "sealed", "envelope", "patients", "outcome"]
+    documents = []
+    for doc_idx, n_sentences in enumerate([1, 3, 4, 5, 5, 8, 12, 20, 27]):
+        sentences = [" ".join(random_state.choice(words, 5)) for _ in range(n_sentences)]
+        labels = np.zeros((n_sentences, len(RA_CNN_redux.SENT_OUTCOMES)))
+        labels[:, 0] = random_state.rand(n_sentences) < 0.3
+        labels[0, 0] = 1
+        documents.append(Document(doc_idx, sentences, sentence_labels=labels))
+    # all rationales: nothing to balance against, in a bucket of its own length
+    documents[4].sentence_labels[:, 0] = 1
+
+    p = RA_CNN_redux.Preprocessor(max_features=50, max_sent_len=MAX_SENT_LEN,
+                                    max_doc_len=MAX_DOC_LEN)
+    p.preprocess([s for d in documents for s in d.sentences])
+    return Corpus.from_documents(documents, p)
+
+
+def test_bucketed_sentence_batches():
+    corpus = make_corpus()
+    doc_indices = np.arange(len(corpus))
+    _, y = corpus.batch(doc_indices)
+    weights = RA_CNN_redux.RationaleCNN._get_val_weights(y)
+    batches = CorpusBatches(corpus, doc_indices, batch_size=4, y=y, sample_weight=weights,
+                            bucket_width=5, per_sentence=True)
+    for batch_idx in range(len(batches)):
+        X, y_b, w_b = batches[batch_idx]
+        n, length = X.shape[:2]
+        assert length % 5 == 0 and length <= MAX_DOC_LEN
+        assert X.shape == (n, length, MAX_SENT_LEN)
+        for name in y_b:
+            assert y_b[name].shape == (n, length, 1)
+            assert w_b[name].shape == (n, length)
+
+
+def test_bucketed_balanced_batches():
+    corpus = make_corpus()
+    np.random.seed(0)
+    batches = BalancedSentenceBatches(corpus, np.arange(len(corpus)), batch_size=3,
+                                        shuffle=True, bucket_width=5)
+    for batch_idx in range(len(batches)):
+        X, y = batches[batch_idx]
+        for name in y:
+            assert y[name].shape == X.shape[:2] + (1,)
+
+
+def test_bucketed_document_batches():
+    corpus = make_corpus()
+    doc_indices = np.arange(len(corpus))
+    y = {"doc_prediction": np.eye(3)[doc_indices % 3]}
+    batches = CorpusBatches(corpus, doc_indices, batch_size=4, y=y, bucket_width=5)
+    for batch_idx in range(len(batches)):
+        X, y_b = batches[batch_idx]
+        assert y_b["doc_prediction"].shape == (X.shape[0], 3)
@@ -24,65 +24,154 @@ from keras.callbacks import ModelCheckpoint
 
 
 import RA_CNN_redux
+import RA_CNN_cache
+import RA_CNN_vectors
 from RA_CNN_redux import Document
+from read_data import load_formatted_df
 
 
-def load_trained_w2v_model(path="/work/03213/bwallace/maverick/RoB_CNNs/PubMed-w2v.bin"):
+def load_trained_w2v_model(path="/work/03213/bwallace/maverick/RoB_CNNs/PubMed-w2v.bin", 
+                            words=None):
+    '''
+    path is either a word2vec binary, or a directory of vectors converted
+    from one by RA_CNN_vectors; in the latter case only the vectors for
+    words (if given) are read, which is much faster.
+    '''
+    if RA_CNN_vectors.is_converted(path):
+        return RA_CNN_vectors.load_vectors(path, words=words)
     m = gensim.models.KeyedVectors.load_word2vec_format(path, binary=True)
     #m = Word2Vec.load_word2vec_format(path, binary=True)
     return m
 
-def read_data(path_to_csv="data/small-data.csv"):
-    ''' 
-    
+DOC_LBL_MAP = {"low":np.array([1,0,0]),
+                "high":np.array([0,1,0]),
+                "unclear":np.array([0,1,0]), # note that we map high and unclear to the same category!
+                "unk":np.array([0,0,1])}
+
+
+def group_documents(df, doc_judgments, sent_judgments, doc_lbl_map=DOC_LBL_MAP):
+    '''
+    Group formatted data (one row per sentence) by doc_id in a single
+    pass over NumPy arrays, rather than building a DataFrame per
+    document. Returns
+
+     - doc_ids, sorted (as groupby has them);
+     - offsets, such that document i holds rows offsets[i]:offsets[i+1] of
+     - sentences and sent_labels (a sentences x sent_judgments matrix),
+       which are otherwise in their original order; and
+     - doc_labels, mapping each of the doc_judgments to a (documents x
+       categories) matrix of one-hot labels (see doc_lbl_map).
+
+    Document level labels are repeated on each of a document's rows;
+    documents for which these differ, or are not in doc_lbl_map, are
+    listed and a ValueError is raised.
     '''
-    tp = pd.read_csv(path_to_csv, chunksize=10000)
-    df = pd.concat(tp, ignore_index=True)
+    df = df[pd.notnull(df["doc_id"])]
+    doc_codes, doc_ids = pd.factorize(df["doc_id"], sort=True)
+    order = np.argsort(doc_codes, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(doc_codes, minlength=len(doc_ids)))])
+    starts, counts = offsets[:-1], np.diff(offsets)
+
+    doc_labels, problems = {}, []
+    for dj in doc_judgments:
+        values = df[dj].values[order]
+        # (missing values get code -1)
+        lbl_codes, lbl_values = pd.factorize(values)
+        doc_codes_dj = lbl_codes[starts]
+        inconsistent = np.zeros(len(doc_ids), dtype=bool)
+        if len(doc_ids) > 0:
+            differs = lbl_codes != np.repeat(doc_codes_dj, counts)
+            inconsistent = np.logical_or.reduceat(differs, starts)
+        # the extra last entry is for code -1
+        known = np.array([value in doc_lbl_map for value in lbl_values] + [False])
+        one_hot = np.vstack([doc_lbl_map.get(value, 0 * doc_lbl_map["unk"])
+                                for value in lbl_values] + [0 * doc_lbl_map["unk"]])
+
+        for doc_idx in np.nonzero(inconsistent)[0]:
+            doc_values = values[starts[doc_idx]:offsets[doc_idx+1]]
+            problems.append("{0}: inconsistent {1} labels ({2})".format(
+                                doc_ids[doc_idx], dj, ", ".join(sorted(set(map(str, doc_values))))))
+        for doc_idx in np.nonzero(~inconsistent & ~known[doc_codes_dj])[0]:
+            problems.append("{0}: unknown {1} label ({2})".format(
+                                doc_ids[doc_idx], dj, values[starts[doc_idx]]))
+        doc_labels[dj] = one_hot[doc_codes_dj]
+
+    if len(problems) > 0:
+        for problem in problems:
+            print(problem)
+        raise ValueError("{0} documents with invalid labels (listed above)".format(len(problems)))
+
+    sentences = df["sentence"].values[order]
+    sent_labels = df[sent_judgments].values[order]
+    return list(doc_ids), offsets, sentences, sent_labels, doc_labels
 
+
+def read_data(path_to_csv="data/small-data.csv"):
+    '''
+    path_to_csv may also point to a directory of normalized (Parquet)
+    formatted data; in that case we read only the columns used here.
+    '''
     doc_judgments = RA_CNN_redux.DOC_OUTCOMES
     sent_judgments = RA_CNN_redux.SENT_OUTCOMES
 
-    doc_lbl_map = {"low":np.array([1,0,0]),
-                    "high":np.array([0,1,0]),
-                    "unclear":np.array([0,1,0]), # note that we map high and unclear to the same category!
-                    "unk":np.array([0,0,1])}
-                   
+    df = load_formatted_df(path_to_csv, doc_columns=["doc_id"] + doc_judgments,
+                            sentence_columns=["sentence"] + sent_judgments)
 
     # recall that the assumption now is doc_id is *either* PMID or DOI,
     # we will use the former where available and default to the latter
     # otherwise.
-    docs = df.groupby("doc_id")
+    doc_ids, offsets, sentences, sent_labels, doc_labels = group_documents(
+                                                df, doc_judgments, sent_judgments)
     documents = []
-    for doc_id, doc in docs:
-        # only need the first because document-level labels are repeated
-        #doc_label = (doc["doc_lbl"].values[0]+1)/2 # convert to 0/1
-        doc_lbl_dict = {}
-        for dj in doc_judgments:
-            if not doc[dj].unique().shape[0]==1:
-                print("??!?!")
-                import pdb; pdb.set_trace()
-
-            # note that the doc level label is just repeated;
-            # so we take the first
-            assert(doc[dj].unique().shape[0]==1)
-            doc_lbl_dict["doc_prediction_"+dj] = doc_lbl_map[doc[dj].values[0]]
-
-        sentences = doc["sentence"].values
-        sentence_label_dicts = []
-        
-        for idx, row in doc.iterrows():
-            cur_sent_lbl_dict = {}
-            for sj in sent_judgments:
-                cur_sent_lbl_dict[sj] = row[sj]
-            sentence_label_dicts.append(cur_sent_lbl_dict)
-
-        cur_doc = Document(doc_id, sentences,  doc_lbl_dict=doc_lbl_dict, 
-                            sentence_lbl_dicts=sentence_label_dicts)
+    for doc_idx, doc_id in enumerate(doc_ids):
+        start, end = offsets[doc_idx], offsets[doc_idx+1]
+        doc_lbl_dict = {"doc_prediction_"+dj: doc_labels[dj][doc_idx] for dj in doc_judgments}
+        cur_doc = Document(doc_id, sentences[start:end], doc_lbl_dict=doc_lbl_dict,
+                            sentence_labels=sent_labels[start:end])
         documents.append(cur_doc)
 
     return documents
 
 
+def load_documents(data_path, cache_dir=None, p=None, wvs=None, max_features=20000,
+                    max_sent_len=25, max_doc_len=200, stopword=True, n_jobs=None):
+    '''
+    Returns the documents in data_path, with their sentence sequences
+    generated (in n_jobs processes; see Preprocessor.encode_documents), 
+    and the Preprocessor these were generated with: p, if given, and 
+    otherwise one fit to the documents (with word vectors wvs).
+
+    If cache_dir is given, the result is read from there when it holds
+    a cache of the same data and preprocessing (see RA_CNN_cache), and
+    written there otherwise.
+    '''
+    if p is None:
+        params = {"max_features": max_features, "max_sent_len": max_sent_len,
+                    "max_doc_len": max_doc_len, "stopword": stopword}
+    else:
+        params = RA_CNN_cache.preprocessor_params(p)
+
+    if cache_dir is not None:
+        source = RA_CNN_cache.source_info(data_path)
+        if RA_CNN_cache.is_current(cache_dir, source, params, p=p):
+            return RA_CNN_cache.load_cache(cache_dir, p=p, wvs=wvs)
+
+    documents = read_data(path_to_csv=data_path)
+    if p is None:
+        all_sentences = []
+        for d in documents: 
+            all_sentences.extend(d.sentences)
+
+        p = RA_CNN_redux.Preprocessor(wvs=wvs, **params)
+        p.preprocess(all_sentences)
+
+    p.encode_documents(documents, n_jobs=n_jobs)
+
+    if cache_dir is not None:
+        RA_CNN_cache.write_cache(cache_dir, documents, p, source)
+    return documents, p
+
+
 
 
 def line_search_train(data_path, wvs_path, documents=None, test_mode=False, 
@@ -144,8 +233,9 @@ def line_search_train(data_path, wvs_path, documents=None, test_mode=False,
 
 
 
-def calculate_performance_on_dev_set(r_CNN, path_to_dev_data="data/splits/dev-df.csv"):
-    dev_docs = read_data(path_to_dev_data)
+def calculate_performance_on_dev_set(r_CNN, path_to_dev_data="data/splits/dev-df.csv", 
+                                        cache_dir=None):
+    dev_docs, _ = load_documents(path_to_dev_data, cache_dir=cache_dir, p=r_CNN.preprocessor)
     acc_dicts = defaultdict(list)
     pred_dicts = defaultdict(list)
     dev_preds = r_CNN.predictions_for_docs(dev_docs)
@@ -184,36 +274,48 @@ def train_CNN_rationales_model(data_path, wvs_path, documents=None, test_mode=Fa
                                 end_to_end_train=False,
                                 downsample=False,
                                 stopword=True,
-                                pos_class_weight=1):
-    
-    
+                                pos_class_weight=1,
+                                cache_dir=None, dev_cache_dir=None,
+                                bucket_width=None, n_jobs=None):
+    '''
+    cache_dir and dev_cache_dir, if given, are where to cache the
+    (tokenized) training and dev documents; see load_documents.
+
+    bucket_width, if given, batches documents by length (see 
+    RA_CNN_redux.RationaleCNN); n_jobs is the number of processes to 
+    generate sentence sequences in (by default, one per core).
+    '''
     if documents is None:
-        documents = read_data(path_to_csv=data_path)
-        #documents = read_data()
+        documents, p = load_documents(data_path, cache_dir=cache_dir, 
+                                        max_features=max_features, 
+                                        max_sent_len=max_sent_len, 
+                                        max_doc_len=max_doc_len, 
+                                        stopword=stopword, n_jobs=n_jobs)
         if shuffle_data: 
             random.shuffle(documents)
+    else:
+        all_sentences = []
+        for d in documents: 
+            all_sentences.extend(d.sentences)
 
-    wvs = load_trained_w2v_model(path=wvs_path)
-
-    all_sentences = []
-    for d in documents: 
-        all_sentences.extend(d.sentences)
+        p = RA_CNN_redux.Preprocessor(max_features=max_features, 
+                                        max_sent_len=max_sent_len, 
+                                        max_doc_len=max_doc_len, 
+                                        stopword=stopword)
 
-    p = RA_CNN_redux.Preprocessor(max_features=max_features, 
-                                    max_sent_len=max_sent_len, 
-                                    max_doc_len=max_doc_len, 
-                                    wvs=wvs, stopword=stopword)
+        # need to do this!
+        p.preprocess(all_sentences)
+        p.encode_documents(documents, n_jobs=n_jobs)
 
-    # need to do this!
-    p.preprocess(all_sentences)
-    for d in documents: 
-        d.generate_sequences(p)
+    # word vectors are read once we know which we need
+    p.set_word_vectors(load_trained_w2v_model(path=wvs_path, words=p.vocabulary()))
 
     r_CNN = RA_CNN_redux.RationaleCNN(p, filters=[1,2,3], 
                                         n_filters=n_filters, 
                                         sent_dropout=sentence_dropout, 
                                         doc_dropout=document_dropout,
-                                        end_to_end_train=end_to_end_train)
+                                        end_to_end_train=end_to_end_train,
+                                        bucket_width=bucket_width)
 
 
     ###################################
@@ -266,7 +368,7 @@ def train_CNN_rationales_model(data_path, wvs_path, documents=None, test_mode=Fa
     r_CNN.doc_model.load_weights(doc_weights_path)
 
     # @TODO 2/26
-    dev_results = calculate_performance_on_dev_set(r_CNN)
+    dev_results = calculate_performance_on_dev_set(r_CNN, cache_dir=dev_cache_dir)
     
     # @TODO 2/28
     # now actually calculate perf with preds!
@@ -382,6 +484,14 @@ if __name__ == "__main__":
         help="create balanced mini-batches during training?", 
         action='store_true', default=False) # TODO change to True?
 
+    parser.add_option('--bw', '--bucket-width', dest="bucket_width",
+        help="batch documents by length, padding them to multiples of this many sentences", 
+        default=None, type="int")
+
+    parser.add_option('--nj', '--n-jobs', dest="n_jobs",
+        help="number of processes to generate sentence sequences in (default: one per core)", 
+        default=None, type="int")
+
     parser.add_option('--sw', '--stopword', dest="stopword",
         help="performing stopwording?", 
         action='store_true', default=False)
@@ -416,7 +526,9 @@ if __name__ == "__main__":
                                     end_to_end_train=options.end_to_end_train, 
                                     downsample=options.downsample,
                                     stopword=options.stopword,
-                                    pos_class_weight=options.pos_class_weight)
+                                    pos_class_weight=options.pos_class_weight,
+                                    bucket_width=options.bucket_width,
+                                    n_jobs=options.n_jobs)
         
     
         #import pdb; pdb.set_trace() 